@@ -1,12 +1,15 @@
 import streamlit as st
-import google.generativeai as genai
-import datetime
-import sqlite3
-import json
-import pandas as pd
-import re
-import time
-import os
+from catalog import whitelist_kinds
+from coverage import COVERAGE_FIELDS, portfolio_gaps
+from chat_context import SUMMARY_TRIGGER, plan_chat_context, split_history
+from db import (STAGES, init_db, save_client_to_db, delete_client, load_client,
+                append_messages, count_clients_by_stage, list_clients, get_summary, client_fields)
+from kb_store import get_kb, refresh_kb
+from jobs import submit_analysis, latest_job, job_counts, recent_jobs, mark_seen, submit_summary
+from llm import stream_with_retry, recent_calls
+from metrics import latency_summary
+from model_registry import list_generation_models, get_model
+from scheduler import scheduler
 
 # --- 1. 頁面設定 ---
 st.set_page_config(page_title="保險業務超級軍師", page_icon="🛡️", layout="wide")
@@ -62,46 +65,7 @@ st.markdown("""
 <div class="mars-watermark">Made by Mars Chang</div>
 """, unsafe_allow_html=True)
 
-# --- 4. 資料庫功能 ---
-def init_db():
-    conn = sqlite3.connect('insurance_crm.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS clients
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_key TEXT, name TEXT, stage TEXT, data JSON,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
-
-def save_client_to_db(user_key, name, stage, form_data):
-    conn = sqlite3.connect('insurance_crm.db')
-    c = conn.cursor()
-    c.execute("SELECT id FROM clients WHERE user_key=? AND name=?", (user_key, name))
-    result = c.fetchone()
-    json_data = json.dumps(form_data, default=str)
-    if result:
-        c.execute("UPDATE clients SET stage=?, data=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", (stage, json_data, result[0]))
-    else:
-        c.execute("INSERT INTO clients (user_key, name, stage, data) VALUES (?, ?, ?, ?)", (user_key, name, stage, json_data))
-    conn.commit()
-    conn.close()
-
-def get_clients_by_key(user_key):
-    conn = sqlite3.connect('insurance_crm.db')
-    try:
-        df = pd.read_sql_query("SELECT * FROM clients WHERE user_key=? ORDER BY updated_at DESC", conn, params=(user_key,))
-    except:
-        df = pd.DataFrame()
-    conn.close()
-    return df
-
-def delete_client(user_key, name):
-    conn = sqlite3.connect('insurance_crm.db')
-    c = conn.cursor()
-    c.execute("DELETE FROM clients WHERE user_key=? AND name=?", (user_key, name))
-    conn.commit()
-    conn.close()
-
+# --- 4. 資料庫功能 (見 db.py) ---
 init_db()
 
 # --- 5. 初始化 Session ---
@@ -109,89 +73,43 @@ if "current_client_data" not in st.session_state: st.session_state.current_clien
 if "chat_history" not in st.session_state: st.session_state.chat_history = []
 if "current_strategy" not in st.session_state: st.session_state.current_strategy = None
 if "user_key" not in st.session_state: st.session_state.user_key = ""
-if "kb_text" not in st.session_state: st.session_state.kb_text = ""
-if "kb_count" not in st.session_state: st.session_state.kb_count = 0
-if "kb_debug" not in st.session_state: st.session_state.kb_debug = []
-
-# --- 6. 核心：知識庫讀取 ---
-def load_kb():
-    full_text = ""
-    count = 0
-    debug_log = []
-    all_files = os.listdir('.')
-    debug_log.append(f"📂 目錄: {all_files}")
-
-    # 1. Excel
-    excel_files = [f for f in all_files if f.lower().endswith(('.xlsx', '.xlsm'))]
-    for f in excel_files:
-        try:
-            df = pd.read_excel(f, engine='openpyxl')
-            csv_text = df.to_csv(index=False)
-            full_text += f"\n=== Excel資料庫 ({f}) ===\n{csv_text}\n"
-            count += 1
-            debug_log.append(f"✅ Excel: {f}")
-        except Exception as e:
-            debug_log.append(f"❌ Excel Error {f}: {e}")
-
-    # 2. TXT
-    txt_files = [f for f in all_files if f.lower().endswith('.txt')]
-    for f in txt_files:
-        if "requirements" in f: continue
-        try:
-            with open(f, "r", encoding="utf-8") as file:
-                full_text += f"\n=== 手冊內容 ({f}) ===\n{file.read()}\n"
-                count += 1
-                debug_log.append(f"✅ TXT: {f}")
-        except UnicodeDecodeError:
-            try:
-                with open(f, "r", encoding="cp950") as file:
-                    full_text += f"\n=== 手冊內容 ({f}) ===\n{file.read()}\n"
-                    count += 1
-                    debug_log.append(f"✅ TXT(Big5): {f}")
-            except: debug_log.append(f"❌ TXT Error {f}")
-
-    # 3. PDF
-    if pdf_tool_ready:
-        pdf_files = [f for f in all_files if f.lower().endswith('.pdf')]
-        for f in pdf_files:
-            try:
-                with pdfplumber.open(f) as pdf:
-                    text = "".join([p.extract_text() or "" for p in pdf.pages])
-                    full_text += f"\n=== PDF手冊 ({f}) ===\n{text}\n"
-                    count += 1
-                    debug_log.append(f"✅ PDF: {f}")
-            except Exception as e:
-                debug_log.append(f"❌ PDF Error {f}: {e}")
-    
-    return full_text, count, debug_log
+if "list_pages" not in st.session_state: st.session_state.list_pages = {}
 
-if st.session_state.kb_count == 0:
-    t, c, d = load_kb()
-    st.session_state.kb_text, st.session_state.kb_count, st.session_state.kb_debug = t, c, d
+# --- 6. 核心：知識庫讀取 (整個行程共用，見 kb_store.py) ---
+kb = get_kb()
 
 # --- 7. 工具函數 ---
-def calculate_life_path_number(birth_text):
-    digits = re.findall(r'\d', str(birth_text))
-    if not digits: return 0
-    total = sum(int(digit) for digit in "".join(digits))
-    while total > 9: total = sum(int(digit) for digit in str(total))
-    return total
-
-def generate_with_retry(model, prompt):
-    safety_settings = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-    ]
-    for _ in range(3):
-        try:
-            res = model.generate_content(prompt, safety_settings=safety_settings)
-            if res.text: return res
-        except Exception as e:
-            if "429" in str(e): time.sleep(5)
-            else: raise e
-    raise Exception("API Error")
+CLIENT_PAGE_SIZE = 20
+JOB_POLL_SECONDS = 2
+JOB_ICONS = {"queued": "⏳", "running": "▶️", "done": "✅", "failed": "❌"}
+
+def render_jobs(user_key):
+    counts = job_counts(user_key)
+    if not counts: return False
+    badge = f"🧾 分析工作：⏳ {counts.get('queued', 0)}｜▶️ {counts.get('running', 0)}｜✅ {counts.get('done', 0)}"
+    if counts.get("failed"): badge += f"｜❌ {counts['failed']}"
+    st.caption(badge)
+    with st.expander("工作清單"):
+        for j in recent_jobs(user_key):
+            st.caption(f"{JOB_ICONS.get(j['status'], '')} {j['client_name']}｜{j['note']}" + (f"：{j['error']}" if j['error'] else ""))
+        if st.button("✔️ 清除已完成", key="clear_jobs"):
+            mark_seen(user_key)
+            st.rerun()
+    return counts.get("queued", 0) + counts.get("running", 0) > 0
+
+# 有工作在跑時才定時重跑這一小塊，全部結束後整頁重跑一次，停止輪詢
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_jobs_live(user_key):
+    if not render_jobs(user_key): st.rerun()
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_progress(user_key, name):
+    job = latest_job(user_key, name)
+    if job and job["status"] in ("queued", "running"):
+        st.progress(job["progress"] or 0.0, text=f"教練分析：{job['note']}")
+        if job["result"]: st.markdown(f'<div class="report-box">{job["result"]}</div>', unsafe_allow_html=True)
+        return
+    st.rerun()   # 結束了：整頁重跑，由主畫面載入報告
 
 # --- 8. 側邊欄 ---
 with st.sidebar:
@@ -212,29 +130,38 @@ with st.sidebar:
                 st.session_state.current_client_data = {}
                 st.rerun()
 
-        clients_df = get_clients_by_key(ukey_input)
-        if not clients_df.empty:
-            for s in ["S1", "S2", "S3", "S4", "S5", "S6"]:
-                stage_clients = clients_df[clients_df['stage'].str.startswith(s)]
-                if not stage_clients.empty:
-                    with st.expander(f"📂 {s} ({len(stage_clients)})"):
-                        for _, row in stage_clients.iterrows():
-                            if st.button(f"{row['name']}", key=f"btn_{row['id']}"):
-                                st.session_state.current_client_data = json.loads(row['data'])
-                                st.session_state.current_strategy = st.session_state.current_client_data.get('last_strategy')
-                                st.session_state.chat_history = st.session_state.current_client_data.get('chat_history', [])
-                                st.rerun()
+        search = st.text_input("🔍 搜尋姓名", key="client_search")
+        stage_counts = count_clients_by_stage(ukey_input, search)
+        for s in STAGES:
+            total = stage_counts.get(s, 0)
+            if total:
+                with st.expander(f"📂 {s} ({total})", expanded=s in st.session_state.list_pages):
+                    shown = st.session_state.list_pages.get(s, 1) * CLIENT_PAGE_SIZE
+                    for client_id, name, _, _ in list_clients(ukey_input, s, search, limit=shown):
+                        if st.button(f"{name}", key=f"btn_{client_id}"):
+                            data, strategy, history = load_client(client_id)
+                            mark_seen(ukey_input, name)
+                            st.session_state.current_client_data = data
+                            st.session_state.current_strategy = strategy
+                            st.session_state.chat_history = history
+                            st.rerun()
+                    if total > shown and st.button(f"⬇️ 更多 ({total - shown})", key=f"more_{s}"):
+                        st.session_state.list_pages[s] = st.session_state.list_pages.get(s, 1) + 1
+                        st.rerun()
+
+        if job_counts(ukey_input).keys() & {"queued", "running"}: render_jobs_live(ukey_input)
+        else: render_jobs(ukey_input)
 
     st.markdown("---")
     st.markdown("### 📚 知識庫")
-    if st.session_state.kb_count > 0:
-        st.success(f"✅ {st.session_state.kb_count} 份文件就緒")
+    if kb.count > 0:
+        st.success(f"✅ {kb.count} 份文件就緒")
     else:
         st.info("ℹ️ 無文件")
     with st.expander("🔍 檢查"):
-        for m in st.session_state.kb_debug: st.write(m)
+        for m in kb.debug: st.write(m)
         if st.button("🔄 重掃"):
-            st.session_state.kb_count = 0
+            refresh_kb()
             st.rerun()
 
     st.markdown("---")
@@ -248,16 +175,32 @@ with st.sidebar:
 
     model = None
     if api_key:
-        genai.configure(api_key=api_key)
         try:
-            all_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-            all_models.sort(key=lambda x: "1.5-flash" not in x.lower())
-            
             st.markdown("### 🤖 模型選擇")
+            refresh_models = st.button("🔄 更新模型清單")
+            all_models = list_generation_models(api_key, refresh=refresh_models)
             selected_model_name = st.selectbox("選擇大腦", all_models, index=0)
-            model = genai.GenerativeModel(selected_model_name)
+            model = get_model(api_key, selected_model_name)
             st.success(f"🟢 {selected_model_name}")
         except: st.error("連線失敗")
+        st.checkbox("♻️ 強制重新產生 (略過快取)", key="force_refresh")
+
+    calls = recent_calls()
+    if calls:
+        with st.expander("⏱️ 回應時間"):
+            stats = scheduler.stats
+            st.caption(f"排隊 {scheduler.queue_length()}｜呼叫 {stats['calls']}｜429 {stats['rate_limited']}｜失敗 {stats['failed']}")
+            for c in reversed(calls[-10:]):
+                ttft = f"首字 {c['ttft']:.1f}s / " if c['ttft'] is not None else ""
+                source = "快取" if c.get('cached') else c['model'].split('/')[-1]
+                st.caption(f"{c['label']}｜{ttft}總計 {c['total']:.1f}s｜{source}")
+
+    with st.expander("📈 效能指標"):
+        # 查詢時才讀 metrics 資料表，平常 rerun 不多花時間
+        if st.checkbox("顯示過去 24 小時各階段 p50/p95", key="show_metrics"):
+            summary = latency_summary(24)
+            if summary.empty: st.caption("尚無紀錄")
+            else: st.dataframe(summary, hide_index=True)
 
     if "debug_pdf_text" in st.session_state and st.session_state.debug_pdf_text:
         st.markdown("---")
@@ -272,6 +215,13 @@ with col_t2:
     st.markdown("<h1 style='text-align: center;'>保險業務超級軍師</h1>", unsafe_allow_html=True)
     st.markdown("<p style='text-align: center; color: #bbb;'>顧問式銷售．SPIN 提問．保單健診</p>", unsafe_allow_html=True)
 
+# 全部客戶的保障缺口 (本機計算，不呼叫模型)，點欄位標題即可排序
+if st.session_state.user_key:
+    portfolio = client_fields(st.session_state.user_key, COVERAGE_FIELDS, portfolio_gaps)
+    if len(portfolio):
+        with st.expander(f"📊 保障缺口總覽 ({len(portfolio)} 位，未達標項目最多者在前)"):
+            st.dataframe(portfolio, hide_index=True)
+
 data = st.session_state.current_client_data
 with st.form("client_form"):
     c1, c2 = st.columns([1, 2])
@@ -330,19 +280,6 @@ if save_btn or analyze_btn:
     if not st.session_state.user_key: st.error("請輸入金鑰")
     elif not client_name: st.error("請輸入姓名")
     else:
-        proposal_text = ""
-        # 讀取建議書
-        if uploaded_proposal and pdf_tool_ready:
-            try:
-                with pdfplumber.open(uploaded_proposal) as pdf:
-                    proposal_text = "".join([p.extract_text() or "" for p in pdf.pages])
-            except: pass
-        
-        st.session_state.debug_pdf_text = proposal_text
-        
-        if uploaded_proposal and not proposal_text:
-            st.warning("⚠️ 警告：無法讀取 PDF 內容，可能是圖片掃描檔。AI 將無法進行建議書對照。")
-
         form_data = {
             "name": client_name, "stage": s_stage, "gender": gender, 
             "birthday": str(birthday), "income": income, "job": job, "interests": interests,
@@ -350,9 +287,7 @@ if save_btn or analyze_btn:
             "cov_acc_reim": cov_acc_reim, "cov_cancer": cov_cancer, "cov_major": cov_major,
             "cov_radio": cov_radio, "cov_chemo": cov_chemo, "cov_ltc": cov_ltc, 
             "cov_dis": cov_dis, "cov_life": cov_life, "history_note": history_note,
-            "quotes": quotes, "target_product": target_product,
-            "last_strategy": st.session_state.current_strategy,
-            "chat_history": st.session_state.chat_history
+            "quotes": quotes, "target_product": target_product
         }
         
         save_client_to_db(st.session_state.user_key, client_name, s_stage, form_data)
@@ -362,79 +297,27 @@ if save_btn or analyze_btn:
         if analyze_btn:
             if not model: st.error("請連線")
             else:
-                life_path_num = calculate_life_path_number(birthday)
-                is_flash = "flash" in model.model_name.lower()
-                kb_limit = 35000 if is_flash else 4000
-                kb_context = st.session_state.kb_text[:kb_limit]
-                
-                mars_standards = {
-                    "住院日額": "4000元", "醫療實支實付": "20萬", "定額手術": "1000", 
-                    "意外實支實付": "10萬", "癌症一筆金": "50萬", "重大一筆金": "30萬", 
-                    "放療": "3000", "化療": "3000", 
-                    "長照月給付": "3萬", "失能月給付": "3萬", "壽險": "5倍年薪"
-                }
-
-                current_coverage = {
-                    "住院日額": cov_daily or "0", "醫療實支": cov_med_reim or "0", "定額手術": cov_surg or "0", 
-                    "意外實支": cov_acc_reim or "0", "癌症": cov_cancer or "0", "重大": cov_major or "0", 
-                    "放療": cov_radio or "0", "化療": cov_chemo or "0", 
-                    "長照": cov_ltc or "0", "失能": cov_dis or "0", "壽險": cov_life or "0"
-                }
-
-                proposal_context = ""
-                if proposal_text:
-                    proposal_context = f"\n【📄 上傳建議書內容 (After)】\n{proposal_text[:12000]}\n"
-
-                # ★★★ 關鍵 Prompt：直球對決表格 + 防呆 + 白名單 ★★★
-                prompt = f"""
-                你是「教練 Coach Mars Chang」。
-                請依據【銷售方針】："{target_product}" 進行分析。
-                
-                【戰略 1：表格直球對決 (Strict Table)】
-                請製作一個簡潔表格，直接對照是否達標。***不要列出詳細算式，只要給出總額。***
-                欄位：[檢核項目]、[Mars標準]、[總保障額度 (Before+After)]、[達標狀態]
-                1. [達標狀態] 請用：✅ 達標 / ⚠️ 未達標 (缺口金額)
-                2. [總保障額度] = 用戶表單的 [現有保障] + 建議書中的 [建議書補強]。若無數據填 "0"。
-                3. 請依據以下標準逐項檢核：
-                   {json.dumps(mars_standards, ensure_ascii=False)}
-                
-                【戰略 2：數據防呆 (Sanity Check)】
-                請仔細過濾 PDF 數據，**嚴禁抓取保費**：
-                - **日額/手術/放化療**：僅抓取「元/日」或「元/次」。若看到非整數或過小的數字(如 786)，那是保費，忽略它。
-                - **癌症/重大**：僅抓取「一次金」額度。嚴禁把日額混入。
-                - **意外**：僅抓取「實支實付」額度。忽略身故金。
-                - **醫療實支**：請抓取「住院醫療費用限額」(雜費)。
-                
-                【戰略 3：嚴格白名單】
-                - **壽險**：僅推美元或鑫鑫向榮。
-                - **長照/失能**：僅推「享放心、享安心、享順心、心安心」。絕對禁止用壽險充當。
-                
-                【客戶資料】
-                {client_name}, {life_path_num} 號人, {job}, 年收{income}萬
-                語錄："{quotes}"
-                現有保障：{current_coverage}
-                
-                {proposal_context}
-                【知識庫】: {kb_context}
-
-                【輸出架構】
-                1. **[💖 暖心開場]** (NLP)
-                2. **[❓ SPIN 情境探索]**
-                3. **[📊 保單健診與缺口分析]** (請畫出上述定義的直球對決表格)
-                4. **[🛡️ 專屬規劃建議]** (針對缺口提出 Excel/手冊中的商品建議)
-                5. **[💡 補充建議]** (其他提醒)
-                """
-                
-                with st.spinner("資深顧問 Mars 正在進行保單健診..."):
-                    try:
-                        res = generate_with_retry(model, prompt)
-                        st.session_state.current_strategy = res.text
-                        st.session_state.chat_history = []
-                        form_data['last_strategy'] = res.text
-                        save_client_to_db(st.session_state.user_key, client_name, s_stage, form_data)
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"分析失敗: {e}")
+                # 建議書解析與報告產生都在背景執行，畫面不必等；進度見下方與側邊欄
+                proposal = uploaded_proposal.getvalue() if uploaded_proposal and pdf_tool_ready else None
+                job_id = submit_analysis(st.session_state.user_key, client_name, form_data, model, proposal,
+                                         refresh=st.session_state.get("force_refresh", False))
+                st.session_state.current_client_data = form_data
+                st.success(f"已排入教練分析 (#{job_id})，可以繼續編輯或切換其他客戶")
+
+# 目前客戶的分析工作：進行中顯示進度與串流內容，完成後自動載入報告
+curr_name = st.session_state.current_client_data.get("name")
+if st.session_state.user_key and curr_name:
+    job = latest_job(st.session_state.user_key, curr_name)
+    if job and job["status"] in ("queued", "running"): job_progress(st.session_state.user_key, curr_name)
+    elif job and not job["seen"]:
+        if job["status"] == "done":
+            st.session_state.current_strategy = job["result"]
+            st.session_state.chat_history = []
+            st.session_state.debug_pdf_text = job["proposal_text"]
+            if job["note"].startswith("⚠️"): st.warning(job["note"])
+        else:
+            st.error(f"分析失敗: {job['error']}")
+        mark_seen(st.session_state.user_key, curr_name)
 
 # --- 10. 顯示結果 ---
 if st.session_state.current_strategy:
@@ -462,35 +345,52 @@ if st.session_state.current_strategy:
         
         if not model: st.error("請連線")
         else:
-            with st.spinner("教練思考中..."):
-                is_flash = "flash" in model.model_name.lower()
-                kb_limit = 35000 if is_flash else 4000
-                kb_context = st.session_state.kb_text[:kb_limit]
-                
-                chat_prompt = f"""
-                你是 Coach Mars Chang (20年資深顧問)。
-                參考資料：{kb_context}
-                報告：{st.session_state.current_strategy}
-                
-                【系統強制規則】
-                1. **長照失能白名單**：若問長照/失能，**必須**推薦：**「享放心、享安心、享順心、心安心」**。
-                2. **禁止事項**：**絕對禁止**說「手冊沒有資料」或拿壽險充當長照。
-                3. **壽險規則**：僅推美元或鑫鑫向榮。
-                
-                對話歷史：
-                {st.session_state.chat_history}
+            curr = st.session_state.current_client_data
+            summary, summary_seq = get_summary(st.session_state.user_key, curr['name']) if curr else ("", 0)
+            # 還沒摺進摘要的較舊訊息也以原文放入 (超過預算時平均裁切)，不會有對話兩邊都沒帶到
+            recent, older = split_history(st.session_state.chat_history[:-1], summary_seq)
+            chat_rules = """
+            【系統強制規則】
+            1. **長照失能白名單**：若問長照/失能，**必須**推薦：**「享放心、享安心、享順心、心安心」**。
+            2. **禁止事項**：**絕對禁止**說「手冊沒有資料」或拿壽險充當長照。
+            3. **壽險規則**：僅推美元或鑫鑫向榮。
+            """
+            # 依模型預算裁切報告與對話，剩下的額度給知識庫
+            plan = plan_chat_context(model, chat_rules + prompt, st.session_state.current_strategy, summary, older + recent)
+            kb_limit = plan["kb_chars"]
+            kb_query = " ".join([curr.get("target_product", ""), prompt])
+            product_context, product_marks = kb.catalog.context(kb_query, whitelist_kinds(prompt), kb_limit // 2)
+            kb_context = kb.index.select(kb_query, kb_limit - len(product_context), exclude=product_marks)
+            
+            chat_prompt = f"""
+            你是 Coach Mars Chang (20年資深顧問)。
+            指定及白名單商品：{product_context}
+            參考資料：{kb_context}
+            報告：{plan['report']}
+            {chat_rules}
+            先前對話摘要：{plan['summary'] or "(無)"}
+            最近對話：
+            {plan['turns']}
+            
+            最新問題：{prompt}
+            任務：請回答問題，語氣溫暖專業，並嚴格遵守上述白名單規則。
+            """
+            st.info(f"🙋‍♂️ {prompt}")
+            with st.expander(f"💬 教練回覆", expanded=True):
+                reply_box = st.empty()
+                reply_box.caption("教練思考中...")
+            try:
+                text = stream_with_retry(model, chat_prompt, on_text=reply_box.markdown, label="教練陪練",
+                                         cache_version=kb.version, refresh=st.session_state.get("force_refresh", False),
+                                         on_wait=lambda pos: reply_box.caption(f"⏳ 排隊中：第 {pos} 位，請稍候..."))
+                st.session_state.chat_history.append({"role": "assistant", "content": text})
                 
-                最新問題：{prompt}
-                任務：請回答問題，語氣溫暖專業，並嚴格遵守上述白名單規則。
-                """
-                try:
-                    res = generate_with_retry(model, chat_prompt)
-                    st.session_state.chat_history.append({"role": "assistant", "content": res.text})
-                    
-                    curr = st.session_state.current_client_data
-                    if curr:
-                        curr['chat_history'] = st.session_state.chat_history
-                        save_client_to_db(st.session_state.user_key, curr['name'], curr['stage'], curr)
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"回覆失敗: {e}")
+                if curr:
+                    append_messages(st.session_state.user_key, curr['name'], st.session_state.chat_history[-2:])
+                    # 較舊的對話累積夠多就在背景摺進摘要，之後的提示詞不再帶原文
+                    _, older = split_history(st.session_state.chat_history, summary_seq)
+                    if len(older) >= SUMMARY_TRIGGER:
+                        submit_summary(st.session_state.user_key, curr['name'], model, summary, older)
+                st.rerun()
+            except Exception as e:
+                st.error(f"回覆失敗: {e}")
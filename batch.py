@@ -0,0 +1,134 @@
+# --- 批次教練分析 ---
+# 活動前一次更新某位業務 (user_key) 某階段所有客戶的戰略報告，例如：
+#   python batch.py --user-key 我的金鑰 --stage S4
+#   python batch.py --user-key 我的金鑰 --stage S4 --stub      (不連網，用假模型試跑)
+#   python batch.py --user-key 我的金鑰 --stage S4 --refresh   (不用 AI 回應快取，全部重新產生)
+# 提示詞與 app.py 相同 (prompts.py)，呼叫經過同一個排程器限速；每完成一位就寫入檢查點，
+# 中斷後再執行同一指令會跳過已完成的客戶；整批成功跑完後檢查點自動清除。
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from db import init_db, list_clients, load_client, save_strategy
+from kb_store import get_kb
+from llm import generate_with_retry
+from prompts import build_analysis_prompt
+
+CHECKPOINT_DIR = ".batch_checkpoints"
+DEFAULT_MODEL = "models/gemini-1.5-flash"
+
+
+class StubModel:
+    # 不連網的假模型：固定延遲後回傳簡短報告，用來試跑流程或測試
+    def __init__(self, model_name="models/stub-flash", latency=0.0):
+        self.model_name = model_name
+        self.latency = latency
+
+    def generate_content(self, prompt, safety_settings=None, stream=False):
+        if self.latency: time.sleep(self.latency)
+        return _StubResponse(f"# 教練戰略報告 (測試)\n\n提示詞長度：{len(prompt)} 字")
+
+
+class _StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+def checkpoint_path(user_key, stage):
+    safe = "".join(ch if ch.isalnum() else "_" for ch in f"{user_key}_{stage}")
+    return os.path.join(CHECKPOINT_DIR, f"{safe}.json")
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            return set(json.load(fh).get("done", []))
+    except (OSError, ValueError):
+        return set()
+
+
+def _save_checkpoint(path, done):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump({"done": sorted(done), "updated_at": time.time()}, fh)
+    os.replace(tmp, path)
+
+
+def run_batch(user_key, stage, model, workers=4, restart=False, limit=None, refresh=False, log=print):
+    # 回傳 {"done": 成功數, "skipped": 先前已完成, "unchanged": 報告與上一份相同, "failed": [(姓名, 錯誤)]}
+    init_db()
+    kb = get_kb()
+    stage = stage[:2]
+    path = checkpoint_path(user_key, stage)
+    done = set() if restart else _load_checkpoint(path)
+    clients = list_clients(user_key, stage, limit=-1)
+    pending = [(cid, name) for cid, name, _, _ in clients if cid not in done]
+    todo = pending[:limit] if limit else pending
+    log(f"{stage}：共 {len(clients)} 位，先前已完成 {len(clients) - len(pending)} 位，本次處理 {len(todo)} 位")
+
+    lock = threading.Lock()
+    result = {"done": 0, "skipped": len(clients) - len(pending), "unchanged": 0, "failed": []}
+
+    def analyze(client_id, name):
+        data, _, _ = load_client(client_id)
+        prompt = build_analysis_prompt(kb, data, model)
+        res = generate_with_retry(model, prompt, label="批次分析", cache_version=kb.version, refresh=refresh)
+        return client_id, save_strategy(user_key, name, res.text)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(analyze, cid, name): name for cid, name in todo}
+        for fut in as_completed(futures):
+            name = futures[fut]
+            try:
+                client_id, saved = fut.result()
+            except Exception as e:
+                result["failed"].append((name, str(e)))
+                log(f"❌ {name}: {e}")
+                continue
+            with lock:
+                done.add(client_id)
+                _save_checkpoint(path, done)
+                result["done"] += 1
+                if not saved: result["unchanged"] += 1
+            log(f"✅ {name} ({result['done']}/{len(todo)}){'' if saved else ' 報告未變動'}")
+    # 全部跑完且沒有失敗就清掉檢查點，下次活動從頭開始
+    if not result["failed"] and len(todo) == len(pending) and os.path.exists(path): os.remove(path)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批次更新客戶的教練戰略報告")
+    parser.add_argument("--user-key", required=True, help="業務專屬金鑰")
+    parser.add_argument("--stage", required=True, help="銷售階段，如 S4")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--workers", type=int, default=4, help="同時處理的客戶數 (實際呼叫仍受排程器限速)")
+    parser.add_argument("--limit", type=int, help="本次最多處理幾位")
+    parser.add_argument("--restart", action="store_true", help="忽略檢查點，全部重跑")
+    parser.add_argument("--refresh", action="store_true", help="不使用 AI 回應快取，重新產生報告")
+    parser.add_argument("--stub", action="store_true", help="使用不連網的假模型")
+    parser.add_argument("--stub-latency", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    if args.stub:
+        model = StubModel(latency=args.stub_latency)
+    else:
+        api_key = os.environ.get("GOOGLE_API_KEY")
+        if not api_key:
+            print("請設定環境變數 GOOGLE_API_KEY，或加上 --stub", file=sys.stderr)
+            return 2
+        from model_registry import get_model
+        model = get_model(api_key, args.model)
+
+    result = run_batch(args.user_key, args.stage, model, workers=args.workers, restart=args.restart, limit=args.limit,
+                       refresh=args.refresh)
+    print(f"完成 {result['done']} (報告未變動 {result['unchanged']})，略過 {result['skipped']}，失敗 {len(result['failed'])}")
+    return 1 if result["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
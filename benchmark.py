@@ -0,0 +1,337 @@
+# --- 效能基準測試 ---
+# 不需要 API Key 與真實客戶資料：在暫存目錄產生假的客戶資料庫 (1k/10k/100k 筆，含報告與對話)、
+# 數 MB 的商品手冊、PDF 與商品 Excel，並用可設定延遲與 429 的假模型，量測
+# 知識庫載入、資料庫存取、側邊欄清單、提示詞組裝與重試流程。結果輸出成 JSON，方便比對版本間的差異：
+#   python benchmark.py --out before.json
+#   python benchmark.py --sizes 1000,10000 --manual-mb 2 --out after.json
+# 同樣的參數與 --seed 產生完全相同的資料。
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import db
+import kb_store
+import scheduler as scheduler_module
+from coverage import COVERAGE_FIELDS, portfolio_gaps
+from llm import generate_with_retry, stream_with_retry
+from product_table import CATEGORY_COLUMNS
+from prompts import build_analysis_prompt
+from proposal import extract_proposal_text
+from scheduler import scheduler
+
+USER_KEY = "bench"
+SURNAMES = "陳林黃張李王吳劉蔡楊許鄭謝郭洪曾邱廖賴周"
+GIVEN = "志明春嬌家豪淑芬建宏美玲俊傑雅婷冠宇怡君"
+JOBS = ["工程師", "護理師", "老師", "業務", "會計", "自營商", "公務員", "設計師"]
+STAGE_NAMES = ["S1：取得名單", "S2：約訪", "S3：初步面談", "S4：發覺需求", "S5：說明建議書", "S6：成交"]
+COVERAGE_SAMPLES = ["", "0", "1000", "2000元/日", "4000", "10萬", "20", "30萬", "50萬", "1.5萬", "3萬", "3倍", "500萬"]
+PRODUCT_WORDS = "安心樂活享福康健鑫富長照醫卡守護傳承美利"
+
+
+# --- 假模型 ---
+class ResourceExhausted(Exception):
+    # 類別名稱與訊息格式和 SDK 的 429 相同，讓重試邏輯走真實的判斷路徑
+    pass
+
+
+class _Usage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+
+
+class _FakeResponse:
+    def __init__(self, text, prompt_tokens=None):
+        self.text = text
+        self.usage_metadata = _Usage(prompt_tokens, len(text)) if prompt_tokens is not None else None
+
+
+class _TokenCount:
+    def __init__(self, total):
+        self.total_tokens = total
+
+
+class FakeModel:
+    # 固定輸出的假 GenerativeModel：latency 為每次呼叫延遲秒數；每 fail_every 次呼叫丟一次 429
+    # (0 表示不丟)；串流時切成 chunks 段，每段之間平均分攤延遲
+    def __init__(self, model_name="models/fake-bench", latency=0.0, fail_every=0, chunks=8, reply_chars=1200):
+        self.model_name = model_name
+        self.latency = latency
+        self.fail_every = fail_every
+        self.chunks = chunks
+        self.reply = ("# 教練戰略報告\n" + "這是固定的測試內容。" * reply_chars)[:reply_chars]
+        self.calls = 0
+
+    def count_tokens(self, text):
+        return _TokenCount(len(str(text)))
+
+    def generate_content(self, prompt, safety_settings=None, stream=False):
+        self.calls += 1
+        if self.fail_every and self.calls % self.fail_every == 0:
+            raise ResourceExhausted("429 Resource has been exhausted (e.g. check quota). retry in 0 s")
+        if not stream:
+            if self.latency: time.sleep(self.latency)
+            return _FakeResponse(self.reply, len(prompt))
+        return self._stream(prompt)
+
+    def _stream(self, prompt):
+        size = max(1, len(self.reply) // self.chunks)
+        pieces = [self.reply[i:i + size] for i in range(0, len(self.reply), size)]
+        for i, piece in enumerate(pieces):
+            if self.latency: time.sleep(self.latency / len(pieces))
+            yield _FakeResponse(piece, len(prompt) if i == len(pieces) - 1 else None)
+
+
+# --- 假資料 ---
+def _client_data(rng, name, stage):
+    data = {"name": name, "stage": stage, "gender": rng.choice(["男", "女"]),
+            "birthday": f"{rng.randint(1950, 2005)}/{rng.randint(1, 12)}/{rng.randint(1, 28)}",
+            "income": str(rng.choice([40, 60, 80, 120, 200])), "job": rng.choice(JOBS),
+            "interests": rng.choice(["登山", "烹飪", "旅遊", "投資", "攝影"]),
+            "quotes": "保費太貴了，我想再考慮一下" if rng.random() < 0.5 else "",
+            "history_note": "去年已買實支，家人有罹癌經驗" * rng.randint(0, 3),
+            "target_product": rng.choice(["用新樂活補日額", "享放心補長照", "鑫鑫向榮規劃壽險", ""])}
+    for field in COVERAGE_FIELDS[1:]: data[field] = rng.choice(COVERAGE_SAMPLES)
+    return data
+
+
+def make_client_db(path, n, seed=0, messages=6):
+    # n 位客戶全部掛在同一個金鑰底下；每位一份報告與平均 messages 則對話
+    rng = random.Random(seed)
+    if os.path.exists(path): os.remove(path)
+    conn = db.get_conn(path)
+    names = set()
+    while len(names) < n:
+        names.add(rng.choice(SURNAMES) + rng.choice(GIVEN) + rng.choice(GIVEN) + str(rng.randint(1, 999)))
+    rows = []
+    for name in sorted(names):
+        stage = rng.choice(STAGE_NAMES)
+        rows.append((USER_KEY, name, stage, json.dumps(_client_data(rng, name, stage), ensure_ascii=False),
+                     f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:00:00"))
+    with conn:
+        conn.executemany("INSERT INTO clients (user_key, name, stage, data, updated_at) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT INTO client_strategies (client_id, seq, content) SELECT id, 1, ? FROM clients",
+                     ("# 教練戰略報告\n" + "分析內容。" * 300,))
+        msgs = []
+        for client_id, strategy_id in conn.execute("SELECT client_id, id FROM client_strategies").fetchall():
+            for seq in range(1, rng.randint(0, messages * 2) + 1):
+                role = "user" if seq % 2 else "assistant"
+                msgs.append((client_id, strategy_id, seq, role, "請問長照怎麼補？" if role == "user" else "建議先補足月給付。" * 20))
+        conn.executemany("INSERT INTO client_messages (client_id, strategy_id, seq, role, content) VALUES (?, ?, ?, ?, ?)", msgs)
+    return sorted(names)
+
+
+def make_manual(path, megabytes, seed=0):
+    # 格式與 AG商品手冊相同：商品標題【代碼】、類別、編號段落，以分隔線隔開；回傳商品代碼
+    rng = random.Random(seed)
+    sep = "\n" + "-" * 50 + "\n"
+    codes, parts, size, i = [], [], 0, 0
+    while size < megabytes * 1024 * 1024:
+        i += 1
+        code = f"BM{i:04d}"
+        name = "".join(rng.choice(PRODUCT_WORDS) for _ in range(4)) + rng.choice(["終身健康保險", "醫療保險附約", "終身壽險", "美元利率變動型終身壽險"])
+        benefit = "\n".join(f"({k}) 給付條件＝被保險人於本契約有效期間內住院診療者，依第{k}條約定給付保險金。" * 3 for k in range(1, 6))
+        block = sep.join([
+            f"{name}【{code}】\n",
+            f"類別 【健康保險主約】 【保險期間】終身\n《保險給付》\n",
+            f"1.【住院日額保險金】\n{benefit}\n",
+            f"2.【手術保險金】\n{benefit}\n",
+            f"1.【繳費年期及承保年齡】\n投保年期 10年期 20年期\n投保年齡 0~{rng.randint(55, 75)} 0~{rng.randint(45, 65)}\n",
+            f"2.【基本保額限制】\n最低 1 單位，最高 {rng.randint(5, 20)} 單位\n",
+        ])
+        parts.append(block)
+        codes.append(code)
+        size += len(block.encode("utf-8"))
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write(sep + sep.join(parts))
+    return codes
+
+
+def make_product_excel(path, codes, seed=0):
+    rng = random.Random(seed)
+    columns = list(dict.fromkeys(c for cols in CATEGORY_COLUMNS.values() for c in cols))
+    rows = [{"商品代碼": code, "基準數": rng.choice([1, 5, 500, 10000]),
+             **{c: rng.choice([0, 0, 0, 1, 100, 1000]) for c in columns}} for code in codes]
+    pd.DataFrame(rows).to_excel(path, index=False, engine="openpyxl")
+
+
+def make_pdf(path, pages, lines_per_page=50):
+    # 不依賴任何 PDF 寫入套件的最小 PDF (Helvetica、純 ASCII)，內容為條款樣式的文字
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for p in range(pages):
+        lines = [f"Article {p + 1}.{l + 1} The insurer pays the daily hospital benefit of {1000 + l * 10} per day." for l in range(lines_per_page)]
+        stream = "BT /F1 9 Tf 36 806 Td 15 TL " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects) + 2} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for num, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{num} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF".encode()
+    with open(path, "wb") as fh:
+        fh.write(bytes(out))
+    return bytes(out)
+
+
+# --- 量測 ---
+def measure(fn, repeat=20, warmup=1, setup=None):
+    # 回傳毫秒統計；setup 在每次量測前執行 (不計時)，用來清快取
+    for _ in range(warmup):
+        if setup: setup()
+        fn()
+    times = []
+    for _ in range(repeat):
+        if setup: setup()
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {"n": repeat, "mean_ms": round(statistics.fmean(times), 3), "p50_ms": round(times[len(times) // 2], 3),
+            "p95_ms": round(times[min(len(times) - 1, int(len(times) * 0.95))], 3),
+            "min_ms": round(times[0], 3), "max_ms": round(times[-1], 3)}
+
+
+def _sidebar(search=""):
+    # 與 app.py 側邊欄相同的查詢：各階段人數，再列出展開階段的第一頁
+    counts = db.count_clients_by_stage(USER_KEY, search)
+    for s in db.STAGES:
+        if counts.get(s): db.list_clients(USER_KEY, s, search, limit=20)
+
+
+def bench_kb(results, args):
+    results["kb.load_cold"] = measure(lambda: kb_store.scan_kb({}), repeat=args.repeat_slow, warmup=0,
+                                      setup=lambda: shutil.rmtree(kb_store.CACHE_DIR, ignore_errors=True))
+    results["kb.load_warm"] = measure(kb_store.scan_kb, repeat=args.repeat_slow)
+    kb = kb_store.refresh_kb()
+    results["kb.select"] = measure(lambda: kb.index.select("住院日額 手術 長照 實支實付", 30000), repeat=args.repeat)
+    results["kb.products_filter"] = measure(lambda: kb.products.filter(["住院日額", "長照月給付"], age=40, currency="新臺幣"),
+                                            repeat=args.repeat)
+    return kb
+
+
+def bench_proposal(results, args, data):
+    import proposal
+    results["proposal.extract_cold"] = measure(lambda: extract_proposal_text(data), repeat=args.repeat_slow, warmup=0,
+                                               setup=proposal._cache.clear)
+    results["proposal.extract_cached"] = measure(lambda: extract_proposal_text(data), repeat=args.repeat)
+
+
+def bench_db(results, args, size, kb):
+    path = f"clients_{size}.db"
+    start = time.perf_counter()
+    names = make_client_db(path, size, seed=args.seed)
+    results[f"db.generate[{size}]"] = {"seconds": round(time.perf_counter() - start, 2)}
+    db.DB_PATH = path
+    rng = random.Random(args.seed)
+    invalidate = lambda: db.invalidate_client_list(USER_KEY)
+    ids = [r[0] for r in db.get_conn().execute("SELECT id FROM clients").fetchall()]
+
+    results[f"sidebar.cold[{size}]"] = measure(_sidebar, repeat=args.repeat, setup=invalidate)
+    results[f"sidebar.cached[{size}]"] = measure(_sidebar, repeat=args.repeat)
+    results[f"sidebar.search[{size}]"] = measure(lambda: _sidebar("陳"), repeat=args.repeat, setup=invalidate)
+    results[f"db.load_client[{size}]"] = measure(lambda: db.load_client(rng.choice(ids)), repeat=args.repeat)
+    results[f"db.save_client[{size}]"] = measure(
+        lambda: db.save_client_to_db(USER_KEY, (n := rng.choice(names)), "S4：發覺需求", _client_data(rng, n, "S4：發覺需求")),
+        repeat=args.repeat)
+    results[f"db.save_strategy[{size}]"] = measure(lambda: db.save_strategy(USER_KEY, rng.choice(names), f"# 報告 {rng.random()}"), repeat=args.repeat)
+    results[f"db.append_messages[{size}]"] = measure(
+        lambda: db.append_messages(USER_KEY, rng.choice(names), [{"role": "user", "content": "問題"}, {"role": "assistant", "content": "回答"}]),
+        repeat=args.repeat)
+    results[f"coverage.portfolio[{size}]"] = measure(
+        lambda: portfolio_gaps(db.client_fields(USER_KEY, COVERAGE_FIELDS)), repeat=args.repeat_slow, setup=invalidate)
+    sample = [db.load_client(i)[0] for i in rng.sample(ids, min(20, len(ids)))]
+    results[f"prompt.build[{size}]"] = measure(
+        lambda: build_analysis_prompt(kb, rng.choice(sample), "models/gemini-1.5-flash"), repeat=args.repeat)
+
+
+def bench_llm(results, args):
+    # 假模型的延遲與 429 都是固定的；退避時間縮小到 args.backoff_base，量的是重試流程本身的開銷
+    scheduler_module.BACKOFF_BASE = args.backoff_base
+    scheduler.configure("fake", 1_000_000, 1_000_000_000)
+    prompt = "請分析客戶保障缺口。" * 2000
+    for name, fail_every in (("ok", 0), ("retry", args.fail_every)):
+        model = FakeModel(latency=args.latency, fail_every=fail_every)
+        results[f"llm.generate_{name}"] = measure(lambda: generate_with_retry(model, prompt, label="bench"), repeat=args.repeat)
+        model = FakeModel(latency=args.latency, fail_every=fail_every)
+        results[f"llm.stream_{name}"] = measure(lambda: stream_with_retry(model, prompt, label="bench"), repeat=args.repeat)
+    results["llm.scheduler_stats"] = dict(scheduler.stats)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="crm_bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)   # 知識庫、快取與資料庫都以目前目錄為準，整個量測在暫存目錄進行
+    try:
+        codes = make_manual("bench_manual.txt", args.manual_mb, seed=args.seed)
+        make_product_excel("bench_products.xlsx", codes, seed=args.seed)
+        make_pdf("bench_terms.pdf", args.pdf_pages)
+        os.makedirs("uploads")   # 建議書放在子目錄，不會被當成知識庫檔案
+        proposal_pdf = make_pdf(os.path.join("uploads", "bench_proposal.pdf"), args.proposal_pages)
+        db.DB_PATH = "bench_kb.db"
+        kb = bench_kb(results, args)
+        bench_proposal(results, args, proposal_pdf)
+        for size in args.sizes: bench_db(results, args, size, kb)
+        bench_llm(results, args)
+    finally:
+        os.chdir(cwd)
+        if args.keep: print(f"資料保留在 {workdir}", file=sys.stderr)
+        else: shutil.rmtree(workdir, ignore_errors=True)
+    return {"meta": {"commit": _git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                     "cpus": os.cpu_count(), "args": {k: v for k, v in vars(args).items() if k != "out"},
+                     "at": time.strftime("%Y-%m-%dT%H:%M:%S")},
+            "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="產生假資料並量測各階段耗時，輸出 JSON")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="客戶資料庫筆數，逗號分隔")
+    parser.add_argument("--manual-mb", type=float, default=3.0, help="假商品手冊大小 (MB)")
+    parser.add_argument("--pdf-pages", type=int, default=40, help="知識庫 PDF 頁數")
+    parser.add_argument("--proposal-pages", type=int, default=30, help="建議書 PDF 頁數")
+    parser.add_argument("--latency", type=float, default=0.02, help="假模型每次呼叫延遲 (秒)")
+    parser.add_argument("--fail-every", type=int, default=3, help="重試測試中每幾次呼叫丟一次 429")
+    parser.add_argument("--backoff-base", type=float, default=0.01, help="重試測試的退避基準秒數")
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--repeat-slow", type=int, default=3, help="較慢項目 (知識庫載入、PDF) 的重複次數")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="保留產生的暫存資料")
+    parser.add_argument("--out", help="輸出檔案 (預設印在標準輸出)")
+    args = parser.parse_args(argv)
+    args.sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+
+    report = json.dumps(run(args), ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            fh.write(report)
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
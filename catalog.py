@@ -0,0 +1,187 @@
+# --- 商品目錄 ---
+# 將 AG商品手冊_整理後.txt 解析成以商品名稱/代碼 (如【BCBRIL】) 為鍵的目錄，
+# 每個商品保留分類後的子段落，提示詞可以直接查表取出白名單與銷售方針指定的商品。
+import re
+import unicodedata
+from itertools import zip_longest
+
+SECTION_SEP = re.compile(r'\n-{5,}\n')
+PRODUCT_TITLE = re.compile(r'^(.+?)\s*【([A-Z0-9]{3,})】\s*$')
+HEADING = re.compile(r'^(?:投保\s*)?\d+\s*\.\s*【([^】]+)】')
+# 投保規定裡不加括號的標題，整行只有編號與短中文標題 (如「3. 保額限制」)；帶標點或數字的是內文條列
+RULE_HEADING = re.compile(r'^(?:投保\s*)?\d+\s*\.\s*([\u4e00-\u9fff][\u4e00-\u9fff、]{1,11})\s*$')
+RATE_TABLE = re.compile(r'^\S*(?:保費表|費率表)')
+PART_HEADING = re.compile(r'^【([^】]+)】')   # 段落開頭不帶編號的標題 (如【註】、【費率折減】)
+DISCLAIMER = "【僅供內部訓練使用"
+COMPANY_PREFIX = "凱基人壽"
+
+SECTION_NAMES = ["類別", "保險給付", "繳費年期及承保年齡", "投保限制", "基本保額限制"]
+TRIM_ORDER = ["保險給付", "投保限制"]   # 單一商品超過字數時依序裁切的子段落
+
+# 白名單 (與提示詞中的規則一致)
+LTC_WHITELIST = ["享放心", "享安心", "享順心", "心安心"]
+LIFE_WHITELIST = ["鑫鑫向榮"]
+
+MIN_ALIAS, MAX_ALIAS = 3, 8
+
+
+def normalize(text):
+    # 手冊中部分字為相容字元 (如「享順⼼⻑期照顧終⾝」)，統一後才能查表
+    return re.sub(r'\s+', '', unicodedata.normalize("NFKC", text)).replace("⻑", "長")
+
+
+def _classify(heading, phase):
+    if any(k in heading for k in ("繳費年期", "承保年齡", "投保年齡", "投保年期", "繳費期間")): return "繳費年期及承保年齡"
+    if "保額" in heading or "投保限額" in heading: return "基本保額限制"
+    if "限制" in heading and "給付" not in heading: return "投保限制"
+    if phase == "給付": return "保險給付"
+    return None
+
+
+def _heading(line, first=False):
+    # 標題行的名稱；費率表開頭回傳空字串 (之後的表格不放入任何子段落)；不是標題回傳 None
+    m = HEADING.match(line) or RULE_HEADING.match(line) or (first and PART_HEADING.match(line))
+    if m: return m.group(1)
+    return "" if RATE_TABLE.match(line) else None
+
+
+def _parse_product(name, code, parts):
+    sections = {k: [] for k in SECTION_NAMES}
+    phase, last_kind = "給付", "保險給付"
+    for part in parts:
+        # 聲明行有時用相容字元 (如「使⽤」)，正規化後再比對
+        lines = [l for l in part.strip().splitlines() if not unicodedata.normalize("NFKC", l).startswith(DISCLAIMER)]
+        if not lines: continue
+        if lines[0].startswith("類別"):
+            sections["類別"].append(lines[0][2:].strip())
+            rest = "\n".join(lines[1:]).strip()
+            if rest: sections["保險給付"].append(rest)
+            continue
+        # 同一段落中間也可能出現新標題 (投保規定常緊接在最後一項給付後面)，逐行切開；
+        # 沒有標題的行是上一段 (可能跨頁) 的延續
+        block = []
+        for i, line in enumerate(lines):
+            heading = _heading(line, first=i == 0)
+            if heading is not None:
+                if last_kind and block: sections[last_kind].append("\n".join(block))
+                block = []
+                last_kind = _classify(heading, phase) if heading else None
+                if heading and last_kind != "保險給付": phase = "規則"
+            block.append(line)
+        if last_kind and block: sections[last_kind].append("\n".join(block))
+    return {"name": name, "code": code, "sections": {k: "\n".join(v) for k, v in sections.items() if v}}
+
+
+def parse_manual(text):
+    # 回傳商品清單 [{name, code, sections}]，保持手冊順序；純資料結構，可直接存進知識庫快照
+    products, current, parts = [], None, []
+    for part in SECTION_SEP.split(text):
+        stripped = part.strip().strip('-').strip()
+        lines = stripped.splitlines()
+        # 標題段落只有商品名稱一行 (偶爾帶著「函修正」之類的殘字)
+        m = PRODUCT_TITLE.match(lines[0]) if lines and len(lines) <= 3 else None
+        if m:
+            if current: products.append(_parse_product(*current, parts))
+            current, parts = (m.group(1).strip(), m.group(2)), []
+        elif current:
+            parts.append(stripped)
+    if current: products.append(_parse_product(*current, parts))
+    return products
+
+
+class Catalog:
+    def __init__(self, products):
+        self.products = {}   # 代碼 -> 商品
+        self.aliases = {}    # 名稱前綴 / 全名 / 代碼 -> [代碼]
+        for p in products:
+            code = p["code"]
+            self.products[code] = p
+            key = normalize(p["name"])
+            if key.startswith(COMPANY_PREFIX): key = key[len(COMPANY_PREFIX):]
+            self._add_alias(code, code)
+            self._add_alias(key, code)
+            for n in range(MIN_ALIAS, min(MAX_ALIAS, len(key)) + 1): self._add_alias(key[:n], code)
+
+    def _add_alias(self, alias, code):
+        codes = self.aliases.setdefault(alias, [])
+        if code not in codes: codes.append(code)
+
+    def __len__(self):
+        return len(self.products)
+
+    def lookup(self, name):
+        # 以名稱 (可只給開頭，如「享放心」) 或代碼查商品
+        key = normalize(name)
+        return [self.products[c] for c in self.aliases.get(key, []) or self.aliases.get(key.upper(), [])]
+
+    def find_mentions(self, text):
+        # 找出一段文字 (如銷售方針) 中提到的商品：對每個位置查不同長度的前綴，最長者優先
+        key, found, i = normalize(text or ""), [], 0
+        while i < len(key):
+            for n in range(min(MAX_ALIAS, len(key) - i), MIN_ALIAS - 1, -1):
+                codes = self.aliases.get(key[i:i + n])
+                if codes and len(codes) <= 2:
+                    found.extend(c for c in codes if c not in found)
+                    i += n - 1
+                    break
+            i += 1
+        return [self.products[c] for c in found]
+
+    def whitelist(self, kind):
+        if kind == "長照失能":
+            return [p for name in LTC_WHITELIST for p in self.lookup(name)]
+        # 壽險：鑫鑫向榮 + 美元壽險
+        usd = [p for p in self.products.values() if "美元" in p["name"] and "壽險" in p["name"]]
+        return [p for name in LIFE_WHITELIST for p in self.lookup(name)] + usd
+
+    def context(self, text, kinds, budget):
+        # 提示詞用：文字中提到的商品優先，其次各類白名單輪流放入；回傳 (內容, 已放入的商品代碼標記)
+        products = self.find_mentions(text)
+        for group in zip_longest(*[self.whitelist(kind) for kind in kinds]):
+            products += [p for p in group if p]
+        rendered = render_products(products, budget=budget, per_product=max(800, budget // 8))
+        marks = [f"【{p['code']}】" for p in products if f"【{p['code']}】" in rendered]
+        return rendered, marks
+
+
+def whitelist_kinds(text):
+    # 依問題內容判斷需要哪一類白名單
+    kinds = []
+    if "長照" in text or "失能" in text: kinds.append("長照失能")
+    if "壽險" in text or "身故" in text: kinds.append("壽險")
+    return kinds
+
+
+def _trim_lines(text, limit):
+    # 以行為單位截斷，不切斷句子中間
+    out, used = [], 0
+    for line in text.splitlines():
+        if used + len(line) + 1 > limit: break
+        out.append(line)
+        used += len(line) + 1
+    return "\n".join(out)
+
+
+def _render_body(p, sections, limit=None):
+    # 字數不夠時先裁最長的「保險給付」，再裁「投保限制」，承保年齡與保額限制等短段落整段保留
+    parts = {k: f"〔{k}〕\n{p['sections'][k]}" for k in sections if k in p["sections"]}
+    for k in TRIM_ORDER:
+        if not limit or k not in parts: continue
+        others = sum(len(v) + 1 for name, v in parts.items() if name != k)
+        if others + len(parts[k]) > limit: parts[k] = _trim_lines(parts[k], limit - others)
+    body = "\n".join(v for v in parts.values() if v)
+    return _trim_lines(body, limit) if limit else body
+
+
+def render_products(products, sections=SECTION_NAMES, budget=None, per_product=None):
+    # 依手冊子段落輸出；per_product 限制單一商品的字數，超出總預算的商品整個略過
+    out, used, seen = [], 0, set()
+    for p in products:
+        if p["code"] in seen: continue
+        seen.add(p["code"])
+        body = _render_body(p, sections, per_product)
+        block = f"### {p['name']}【{p['code']}】\n{body}"
+        if budget is not None and used + len(block) > budget: continue
+        out.append(block)
+        used += len(block)
+    return "\n\n".join(out)
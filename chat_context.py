@@ -0,0 +1,114 @@
+# --- 陪練室對話的 token 預算 ---
+# 每輪提示詞固定在模型的預算內：最近幾則對話原文保留，更早的對話摺進一段滾動摘要 (存在報告底下)，
+# 報告與知識庫依剩下的額度裁切。對話再長，每輪的提示詞大小與延遲都維持差不多。
+import re
+import threading
+
+from scheduler import estimate_tokens, model_name, pick_by_model
+
+# 每輪提示詞的 token 上限 (依模型名稱關鍵字，先符合者優先)
+CHAT_BUDGETS = {"flash": 24000, "pro": 16000, "default": 6000}
+RECENT_MESSAGES = 6        # 最近幾則對話保留原文
+SUMMARY_TRIGGER = 6        # 待摺入摘要的舊訊息累積到這麼多則才更新一次摘要
+SUMMARY_SHARE = 0.10
+REPORT_SHARE = 0.35
+TURNS_SHARE = 0.25
+
+SENTENCE_END = re.compile(r'(?<=[。！？!?；\n])')
+
+_ratio_lock = threading.Lock()
+_ratios = {}   # 模型名稱 -> 實際 token / 粗估 token
+
+
+def chat_budget(model):
+    return pick_by_model(CHAT_BUDGETS, model)
+
+
+class TokenCounter:
+    # 以模型自己的 count_tokens 校正一次粗估比例，之後每輪在本機換算，不必每段都連網計算
+    def __init__(self, model):
+        self.model = model
+        self.name = model_name(model)
+
+    def calibrate(self, sample):
+        with _ratio_lock:
+            if self.name in _ratios: return _ratios[self.name]
+        ratio = 1.0
+        try:
+            actual = self.model.count_tokens(sample).total_tokens
+            ratio = max(0.3, min(3.0, actual / estimate_tokens(sample)))
+        except Exception:
+            pass
+        with _ratio_lock:
+            _ratios[self.name] = ratio
+        return ratio
+
+    def count(self, text):
+        return int(estimate_tokens(text) * _ratios.get(self.name, 1.0))
+
+    def chars_for(self, tokens, sample=""):
+        # token 額度大約對應多少字 (知識庫檢索以字數為預算)
+        per_char = self.count(sample) / max(1, len(sample)) if sample else _ratios.get(self.name, 1.0)
+        return int(tokens / max(per_char, 0.25))
+
+
+def trim_to_tokens(text, tokens, counter):
+    # 依段落、再依句子裁切，不切在句子中間
+    if not text or counter.count(text) <= tokens: return text or ""
+    out, used = [], 0
+    for para in text.split("\n\n"):
+        cost = counter.count(para)
+        if used + cost > tokens:
+            kept = []
+            for sentence in SENTENCE_END.split(para):
+                c = counter.count(sentence)
+                if used + c > tokens: break
+                kept.append(sentence)
+                used += c
+            if kept: out.append("".join(kept))
+            break
+        out.append(para)
+        used += cost
+    return "\n\n".join(out)
+
+
+def format_turns(messages):
+    return "\n".join(f"{'業務' if m['role'] == 'user' else '教練'}：{m['content']}" for m in messages)
+
+
+def split_history(history, summary_seq):
+    # (最近原文, 尚未摺進摘要的較舊訊息)
+    recent = history[-RECENT_MESSAGES:]
+    older = [m for m in history[:-RECENT_MESSAGES] if m.get("seq", 0) > summary_seq] if len(history) > RECENT_MESSAGES else []
+    return recent, older
+
+
+def plan_chat_context(model, fixed, report, summary, recent):
+    # fixed：規則與最新問題等必放內容。回傳裁切後的各段與留給知識庫的字數
+    counter = TokenCounter(model)
+    counter.calibrate(fixed + (report or "")[:2000])
+    budget = chat_budget(model)
+    left = budget - counter.count(fixed)
+    summary = trim_to_tokens(summary, int(budget * SUMMARY_SHARE), counter)
+    turns = format_turns(recent)
+    if counter.count(turns) > budget * TURNS_SHARE:
+        # 最近對話太長時每則平均分配額度，各自依段落裁切
+        per = int(budget * TURNS_SHARE / max(1, len(recent)))
+        turns = format_turns([dict(m, content=trim_to_tokens(m["content"], per, counter)) for m in recent])
+    left -= counter.count(summary) + counter.count(turns)
+    report = trim_to_tokens(report, min(int(budget * REPORT_SHARE), max(0, left)), counter)
+    left -= counter.count(report)
+    kb_chars = counter.chars_for(max(0, left), sample=report or fixed)
+    return {"summary": summary, "turns": turns, "report": report, "kb_chars": kb_chars}
+
+
+def summary_prompt(summary, messages):
+    return f"""
+    你是對話紀錄整理員。請把【既有摘要】與【新增對話】合併成一份新的摘要 (300 字以內，條列)，
+    保留客戶狀況、業務提出的疑問、教練給過的建議與推薦商品，不要加入新內容。
+    【既有摘要】
+    {summary or "(無)"}
+    【新增對話】
+    {format_turns(messages)}
+    """
+
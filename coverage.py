@@ -0,0 +1,122 @@
+# --- 保障缺口計算 (本機、不呼叫模型) ---
+# 把表單上自由填寫的 cov_* 欄位 (如「4000元/日」、「20萬」、「1.5萬」、「5倍」) 轉成數字，
+# 對照 Mars 標準算出每一項的缺口。整批客戶一次以 pandas 向量運算，數千位也只要幾毫秒；
+# 單一客戶的缺口表直接放進提示詞，模型不必再自己做加減。
+import re
+import unicodedata
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# (欄位, 項目名稱, 標準, 未寫單位的數字小於此數時視為「萬」(0 表示一律為元), 顯示單位)；壽險標準為「年薪倍數」
+# 門檻依各項的合理額度而定：月給付填 3 是 3 萬，填 5000 則是 5000 元；一筆金填 50 是 50 萬
+COVERAGE_ITEMS = [
+    ("cov_daily", "住院日額", 4000, 0, "元/日"),
+    ("cov_med_reim", "醫療實支", 200000, 1000, "元"),
+    ("cov_surg", "定額手術", 1000, 0, "元"),
+    ("cov_acc_reim", "意外實支", 100000, 1000, "元"),
+    ("cov_cancer", "癌症一筆金", 500000, 1000, "元"),
+    ("cov_major", "重大一筆金", 300000, 1000, "元"),
+    ("cov_radio", "放療", 3000, 0, "元/日"),
+    ("cov_chemo", "化療", 3000, 0, "元/次"),
+    ("cov_ltc", "長照月給付", 30000, 100, "元/月"),
+    ("cov_dis", "失能月給付", 30000, 100, "元/月"),
+    ("cov_life", "壽險", 5, 10000, "倍年薪"),
+]
+INCOME_WAN_BELOW = 10000   # 年收欄位標示為「萬」，填 80 是 80 萬、填 1200000 是元
+COVERAGE_FIELDS = ["income"] + [item[0] for item in COVERAGE_ITEMS]
+
+AMOUNT = re.compile(r'(\d+(?:\.\d+)?)\s*(千萬|百萬|億|萬|千|百|元|倍)?')
+UNIT_FACTORS = {"億": 1e8, "千萬": 1e7, "百萬": 1e6, "萬": 1e4, "千": 1e3, "百": 1e2, "元": 1.0}
+
+
+@lru_cache(maxsize=4096)
+def parse_amount(text, wan_below=0):
+    # 一段文字 -> (金額, 倍數)；多個數字 (如 2000+2000) 相加，讀不到數字視為 0
+    # wan_below：沒寫單位的數字小於此數時視為萬 (實支填 20 代表 20 萬)
+    text = unicodedata.normalize("NFKC", text).replace(",", "")
+    amount = multiple = 0.0
+    for num, u in AMOUNT.findall(text):
+        num = float(num)
+        if u == "倍": multiple += num
+        elif u: amount += num * UNIT_FACTORS[u]
+        else: amount += num * (1e4 if num < wan_below else 1.0)
+    return amount, multiple
+
+
+def parse_amounts(values, wan_below=0):
+    # 一整欄文字 -> (金額 Series, 倍數 Series)；同樣的寫法只解析一次，再依代碼展開成整欄
+    s = pd.Series(values, dtype="object")
+    codes, uniques = pd.factorize(s)
+    # 最後補一列 0 給空值 (factorize 代碼為 -1)
+    parsed = np.array([parse_amount(str(u), wan_below) for u in uniques] + [(0.0, 0.0)], dtype=float)
+    return pd.Series(parsed[codes, 0], index=s.index), pd.Series(parsed[codes, 1], index=s.index)
+
+
+def coverage_gaps(frame):
+    # frame 一列一位客戶，需有 income 與 cov_* 欄位；回傳 (現有, 標準, 缺口) 三個 DataFrame，欄位為項目名稱
+    frame = frame.reindex(columns=COVERAGE_FIELDS)
+    income, _ = parse_amounts(frame["income"], INCOME_WAN_BELOW)
+    current, standard = {}, {}
+    for field, label, std, wan_below, _ in COVERAGE_ITEMS:
+        amount, multiple = parse_amounts(frame[field], wan_below)
+        if field == "cov_life":
+            # 壽險可填金額或「N倍」年薪；沒填年收就無法判斷標準
+            current[label] = amount + multiple * income
+            standard[label] = (income * std).where(income > 0, np.nan)
+        else:
+            current[label] = amount
+            standard[label] = pd.Series(float(std), index=frame.index)
+    current, standard = pd.DataFrame(current), pd.DataFrame(standard)
+    gap = (standard - current).clip(lower=0)
+    return current, standard, gap
+
+
+def portfolio_gaps(frame):
+    # 整批客戶的缺口總覽，依未達標項目數、平均缺口比例由大到小排序 (frame 另需 name、stage 欄位)
+    current, standard, gap = coverage_gaps(frame)
+    short = (gap > 0).to_numpy()
+    ratio = (gap / standard).to_numpy(dtype=float)
+    worst = np.where(short.any(axis=1), np.nanargmax(np.nan_to_num(ratio, nan=-1.0), axis=1), -1)
+    labels = np.array(list(gap.columns) + [""], dtype=object)
+    table = pd.DataFrame({
+        "姓名": frame["name"].to_numpy(),
+        "階段": frame["stage"].fillna("").str[:2].to_numpy(),
+        "未達標項目": short.sum(axis=1),
+        "平均缺口(%)": np.round(np.nanmean(ratio, axis=1) * 100, 1),
+        "最大缺口項目": labels[worst],
+    })
+    gap_wan = (gap / 1e4).round(1).add_suffix("缺口(萬)").reset_index(drop=True)
+    table = pd.concat([table, gap_wan], axis=1)
+    return table.sort_values(["未達標項目", "平均缺口(%)"], ascending=False, ignore_index=True)
+
+
+def short_items(form_data):
+    # 單一客戶未達標的項目名稱
+    _, _, gap = coverage_gaps(pd.DataFrame([form_data]))
+    return [label for label in gap.columns if gap.at[0, label] > 0]
+
+
+def _fmt(value, unit):
+    if pd.isna(value): return "-"
+    if value >= 1e4 and unit != "元/日": return f"{value / 1e4:g}萬"
+    return f"{value:,.0f}元"
+
+
+def gap_table(form_data):
+    # 單一客戶的缺口表 (Markdown)，放進提示詞
+    current, standard, gap = coverage_gaps(pd.DataFrame([form_data]))
+    income, _ = parse_amounts([form_data.get("income", "")], INCOME_WAN_BELOW)
+    rows = ["| 檢核項目 | Mars標準 | 現有保障 | 缺口 | 狀態 |", "|---|---|---|---|---|"]
+    for _, label, std, _, shown in COVERAGE_ITEMS:
+        cur, need, short = current.at[0, label], standard.at[0, label], gap.at[0, label]
+        if label == "壽險":
+            rule = f"{std}倍年薪 ({_fmt(need, '元')})" if income[0] > 0 else f"{std}倍年薪 (未填年收)"
+        else:
+            rule = _fmt(need, shown)
+        if pd.isna(need): status = "❔ 無法判斷"
+        elif short > 0: status = f"⚠️ 未達標 (缺 {_fmt(short, shown)})"
+        else: status = "✅ 達標"
+        rows.append(f"| {label} | {rule} | {_fmt(cur, shown)} | {_fmt(short, shown)} | {status} |")
+    return "\n".join(rows)
@@ -0,0 +1,305 @@
+# --- 資料庫存取層 ---
+# 整個行程共用一個連線池：執行緒第一次存取時借一條長駐連線，執行緒結束 (Streamlit 每次 rerun 都是新執行緒)
+# 就放回池中給下一個執行緒用，PRAGMA 只在建立連線時設定一次。開啟 WAL 讓多位業務同時存檔不互卡；
+# 結構異動以 PRAGMA user_version 記錄版本，依序套用。
+import json
+import queue
+import sqlite3
+import threading
+
+import pandas as pd
+
+from metrics import timed
+
+DB_PATH = 'insurance_crm.db'
+
+POOL_SIZE = 8          # 每個資料庫檔案最多閒置保留幾條連線，多的直接關閉
+
+_local = threading.local()
+_pools = {}            # 路徑 -> 閒置連線
+_pools_lock = threading.Lock()
+_init_lock = threading.Lock()
+_initialized = set()
+
+# 側邊欄清單快取：{user_key: {查詢參數: 結果}}，該金鑰有存檔/刪除時整組清掉
+_list_cache = {}
+_list_cache_lock = threading.Lock()
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",      # WAL 模式下 NORMAL 即可保證一致性
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",       # 約 16MB
+    "PRAGMA mmap_size=134217728",
+]
+
+RECENT_MESSAGES = 50   # 開啟客戶時只載入最近這麼多則對話
+STAGES = ["S1", "S2", "S3", "S4", "S5", "S6"]
+LIST_CACHE_MAX = 64
+
+
+def _split_history(conn):
+    # v3 資料搬移：把舊版塞在 data JSON 裡的報告與對話搬到各自的資料表
+    rows = conn.execute("SELECT id, data FROM clients WHERE data LIKE '%last_strategy%' OR data LIKE '%chat_history%'").fetchall()
+    for client_id, raw in rows:
+        try: data = json.loads(raw)
+        except (TypeError, ValueError): continue
+        strategy = data.pop("last_strategy", None)
+        history = data.pop("chat_history", None) or []
+        strategy_id = None
+        if strategy:
+            strategy_id = conn.execute("INSERT INTO client_strategies (client_id, seq, content) VALUES (?, 1, ?)",
+                                       (client_id, strategy)).lastrowid
+        conn.executemany("INSERT INTO client_messages (client_id, strategy_id, seq, role, content) VALUES (?, ?, ?, ?, ?)",
+                         [(client_id, strategy_id, i, m.get("role"), m.get("content")) for i, m in enumerate(history, start=1)])
+        conn.execute("UPDATE clients SET data=? WHERE id=?", (json.dumps(data, default=str), client_id))
+
+
+# 每個版本一組 SQL (或搬資料用的函式)；新增版本只要往後加
+MIGRATIONS = [
+    # v1：原始資料表
+    ['''CREATE TABLE IF NOT EXISTS clients
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         user_key TEXT, name TEXT, stage TEXT, data JSON,
+         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)'''],
+    # v2：同一金鑰下姓名唯一 (先清掉舊版可能留下的重複資料，保留最新一筆) + 清單排序用索引
+    ["DELETE FROM clients WHERE id NOT IN (SELECT MAX(id) FROM clients GROUP BY user_key, name)",
+     "CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_key_name ON clients (user_key, name)",
+     "CREATE INDEX IF NOT EXISTS idx_clients_key_updated ON clients (user_key, updated_at)"],
+    # v3：報告與對話改為只新增不改寫的資料表，依 seq 排序
+    ["""CREATE TABLE IF NOT EXISTS client_strategies
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         client_id INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+         seq INTEGER NOT NULL, content TEXT,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         UNIQUE (client_id, seq))""",
+     """CREATE TABLE IF NOT EXISTS client_messages
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         client_id INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+         strategy_id INTEGER REFERENCES client_strategies(id) ON DELETE SET NULL,
+         seq INTEGER NOT NULL, role TEXT, content TEXT,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         UNIQUE (client_id, seq))""",
+     "CREATE INDEX IF NOT EXISTS idx_messages_strategy ON client_messages (strategy_id, seq)",
+     _split_history],
+    # v4：AI 回應快取 (見 response_cache.py)
+    ["""CREATE TABLE IF NOT EXISTS llm_cache
+        (key TEXT PRIMARY KEY, model TEXT, response TEXT,
+         created_at REAL, last_used REAL)""",
+     "CREATE INDEX IF NOT EXISTS idx_llm_cache_used ON llm_cache (last_used)"],
+    # v5：長對話的滾動摘要，掛在報告底下；summary_seq 為已摺進摘要的最後一則訊息序號
+    ["ALTER TABLE client_strategies ADD COLUMN summary TEXT",
+     "ALTER TABLE client_strategies ADD COLUMN summary_seq INTEGER DEFAULT 0"],
+    # v6：各階段耗時與 token 數 (見 metrics.py)
+    ["""CREATE TABLE IF NOT EXISTS metrics
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, at REAL, stage TEXT, model TEXT,
+         duration_ms REAL, prompt_tokens INTEGER, response_tokens INTEGER,
+         retries INTEGER DEFAULT 0, ok INTEGER DEFAULT 1)""",
+     "CREATE INDEX IF NOT EXISTS idx_metrics_at ON metrics (at)"],
+    # v7：背景分析工作 (見 jobs.py)；attachment 為上傳的建議書，工作結束後清掉
+    ["""CREATE TABLE IF NOT EXISTS jobs
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, user_key TEXT, client_name TEXT, model TEXT,
+         status TEXT, progress REAL DEFAULT 0, note TEXT, payload JSON, attachment BLOB,
+         proposal_text TEXT, result TEXT, error TEXT, seen INTEGER DEFAULT 0,
+         created_at REAL, started_at REAL, finished_at REAL)""",
+     "CREATE INDEX IF NOT EXISTS idx_jobs_key_client ON jobs (user_key, client_name, id)",
+     "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)"],
+    # v8：工作由哪個行程執行 (主機:pid:啟動識別碼)，重新啟動時只清掉已結束行程留下的工作
+    ["ALTER TABLE jobs ADD COLUMN owner TEXT"],
+]
+
+
+class _Lease:
+    # 執行緒持有的連線；執行緒結束時 thread-local 被清掉，連線隨之放回池中
+    def __init__(self, path, conn):
+        self.path, self.conn = path, conn
+
+    def __del__(self):
+        try:
+            if self.conn.in_transaction: self.conn.rollback()
+            _pool(self.path).put_nowait(self.conn)
+        except Exception:
+            self.conn.close()
+
+
+def _pool(path):
+    with _pools_lock:
+        return _pools.setdefault(path, queue.Queue(maxsize=POOL_SIZE))
+
+
+def _connect(path):
+    # 連線會被不同執行緒輪流使用 (同一時間只屬於一個執行緒)，所以關掉 check_same_thread
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    for p in PRAGMAS: conn.execute(p)
+    return conn
+
+
+def get_conn(path=None):
+    path = path or DB_PATH
+    leases = getattr(_local, "leases", None)
+    if leases is None: leases = _local.leases = {}
+    lease = leases.get(path)
+    if lease is None:
+        try: conn = _pool(path).get_nowait()
+        except queue.Empty: conn = _connect(path)
+        lease = leases[path] = _Lease(path, conn)
+        if path not in _initialized: _migrate(conn, path)
+    return lease.conn
+
+
+def _migrate(conn, path):
+    with _init_lock:
+        if path in _initialized: return
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for v, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            with conn:
+                for sql in statements:
+                    if callable(sql): sql(conn)
+                    else: conn.execute(sql)
+                conn.execute(f"PRAGMA user_version={v}")
+        _initialized.add(path)
+
+
+def init_db():
+    get_conn()
+
+
+@timed("db.save_client_to_db")
+def save_client_to_db(user_key, name, stage, form_data):
+    # 報告與對話另存 (save_strategy / append_messages)，這裡只存表單欄位
+    form_data = {k: v for k, v in form_data.items() if k not in ("last_strategy", "chat_history")}
+    conn = get_conn()
+    with conn:
+        conn.execute('''INSERT INTO clients (user_key, name, stage, data) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(user_key, name) DO UPDATE SET
+                        stage=excluded.stage, data=excluded.data, updated_at=CURRENT_TIMESTAMP''',
+                     (user_key, name, stage, json.dumps(form_data, default=str)))
+    invalidate_client_list(user_key)
+
+
+@timed("db.delete_client")
+def delete_client(user_key, name):
+    conn = get_conn()
+    with conn:
+        conn.execute("DELETE FROM clients WHERE user_key=? AND name=?", (user_key, name))
+    invalidate_client_list(user_key)
+
+
+# --- 側邊欄清單 (只取 id/姓名/階段/時間，不碰 data 欄位) ---
+def invalidate_client_list(user_key):
+    with _list_cache_lock:
+        _list_cache.pop(user_key, None)
+
+
+def _cached(user_key, key, fn):
+    with _list_cache_lock:
+        hit = _list_cache.get(user_key, {}).get(key)
+    if hit is not None: return hit
+    result = fn()
+    with _list_cache_lock:
+        entries = _list_cache.setdefault(user_key, {})
+        if len(entries) >= LIST_CACHE_MAX: entries.clear()   # 搜尋字串一直變時避免無限增長
+        entries[key] = result
+    return result
+
+
+@timed("db.count_clients_by_stage")
+def count_clients_by_stage(user_key, search=""):
+    # {階段代號: 人數}，例如 {"S1": 12, "S4": 3}
+    def query():
+        rows = get_conn().execute('''SELECT substr(stage, 1, 2), COUNT(*) FROM clients
+                                     WHERE user_key=? AND instr(name, ?) > 0 GROUP BY 1''', (user_key, search)).fetchall()
+        return dict(rows)
+    return _cached(user_key, ("count", search), query)
+
+
+@timed("db.list_clients")
+def list_clients(user_key, stage_prefix, search="", limit=20, offset=0):
+    # 某階段的一頁客戶 [(id, name, stage, updated_at)]，依最後更新時間排序；姓名搜尋在 SQL 內完成
+    def query():
+        return get_conn().execute('''SELECT id, name, stage, updated_at FROM clients
+                                     WHERE user_key=? AND substr(stage, 1, 2)=? AND instr(name, ?) > 0
+                                     ORDER BY updated_at DESC LIMIT ? OFFSET ?''',
+                                  (user_key, stage_prefix, search, limit, offset)).fetchall()
+    return _cached(user_key, ("list", stage_prefix, search, limit, offset), query)
+
+
+@timed("db.client_fields")
+def client_fields(user_key, fields, derive=None):
+    # 該金鑰所有客戶的指定表單欄位 (DataFrame：name, stage, 各欄位)，以 json_extract 在 SQL 內取出；
+    # 給 derive 時回傳 derive(表格)，結果一起快取，存檔/刪除時同樣失效
+    fields = tuple(fields)
+    def query():
+        cols = ", ".join(f"json_extract(data, '$.{f}') AS {f}" for f in fields)
+        return pd.read_sql_query(f"SELECT name, stage, {cols} FROM clients WHERE user_key=? ORDER BY updated_at DESC",
+                                 get_conn(), params=(user_key,))
+    frame = _cached(user_key, ("fields", fields), query)
+    if derive is None: return frame
+    return _cached(user_key, ("fields", fields, derive), lambda: derive(frame))
+
+
+@timed("db.load_client")
+def load_client(client_id, message_limit=RECENT_MESSAGES):
+    # 開啟客戶：表單欄位 + 最新一份報告 + 該報告之後最近一頁對話 (每則帶 seq)
+    conn = get_conn()
+    row = conn.execute("SELECT data FROM clients WHERE id=?", (client_id,)).fetchone()
+    if not row: return {}, None, []
+    data = json.loads(row[0])
+    strat = conn.execute("SELECT id, content FROM client_strategies WHERE client_id=? ORDER BY seq DESC LIMIT 1",
+                         (client_id,)).fetchone()
+    if strat:
+        msgs = conn.execute("SELECT role, content, seq FROM client_messages WHERE strategy_id=? ORDER BY seq DESC LIMIT ?",
+                            (strat[0], message_limit)).fetchall()
+    else:
+        msgs = conn.execute("SELECT role, content, seq FROM client_messages WHERE client_id=? AND strategy_id IS NULL ORDER BY seq DESC LIMIT ?",
+                            (client_id, message_limit)).fetchall()
+    history = [{"role": r, "content": c, "seq": q} for r, c, q in reversed(msgs)]
+    return data, strat[1] if strat else None, history
+
+
+@timed("db.save_strategy")
+def save_strategy(user_key, name, content):
+    # 新報告：一筆 INSERT，之後的對話都掛在這份報告底下；與最新一份內容相同 (例如快取命中) 就不新增，
+    # 避免把目前的對話與摘要拆開。回傳是否有新增
+    conn = get_conn()
+    with conn:
+        cur = conn.execute('''INSERT INTO client_strategies (client_id, seq, content)
+                              SELECT id, COALESCE((SELECT MAX(seq) FROM client_strategies WHERE client_id=clients.id), 0) + 1, ?
+                              FROM clients WHERE user_key=? AND name=?
+                              AND COALESCE((SELECT content FROM client_strategies WHERE client_id=clients.id
+                                            ORDER BY seq DESC LIMIT 1), '') != ?''', (content, user_key, name, content))
+    return cur.rowcount > 0
+
+
+@timed("db.append_messages")
+def append_messages(user_key, name, messages):
+    # 一輪對話 (提問 + 回覆) 在同一個交易中各一筆小 INSERT，不再改寫整份客戶資料；
+    # 寫入後把配到的 seq 填回每則訊息
+    conn = get_conn()
+    with conn:
+        for m in messages:
+            row = conn.execute('''INSERT INTO client_messages (client_id, strategy_id, seq, role, content)
+                                  SELECT id,
+                                         (SELECT id FROM client_strategies WHERE client_id=clients.id ORDER BY seq DESC LIMIT 1),
+                                         COALESCE((SELECT MAX(seq) FROM client_messages WHERE client_id=clients.id), 0) + 1, ?, ?
+                                  FROM clients WHERE user_key=? AND name=? RETURNING seq''',
+                               (m["role"], m["content"], user_key, name)).fetchone()
+            if row: m["seq"] = row[0]
+
+
+def get_summary(user_key, name):
+    # 最新報告底下的對話摘要：(摘要, 已摺入的最後 seq)
+    row = get_conn().execute('''SELECT s.summary, s.summary_seq FROM client_strategies s JOIN clients c ON c.id=s.client_id
+                                 WHERE c.user_key=? AND c.name=? ORDER BY s.seq DESC LIMIT 1''', (user_key, name)).fetchone()
+    return (row[0] or "", row[1] or 0) if row else ("", 0)
+
+
+def save_summary(user_key, name, summary, upto_seq):
+    conn = get_conn()
+    with conn:
+        conn.execute('''UPDATE client_strategies SET summary=?, summary_seq=?
+                        WHERE id=(SELECT s.id FROM client_strategies s JOIN clients c ON c.id=s.client_id
+                                  WHERE c.user_key=? AND c.name=? ORDER BY s.seq DESC LIMIT 1)''',
+                     (summary, upto_seq, user_key, name))
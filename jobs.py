@@ -0,0 +1,173 @@
+# --- 背景分析工作 ---
+# 「🚀 儲存並啟動教練分析」只把工作寫進 jobs 資料表就回到畫面，PDF 解析與 Gemini 呼叫交給整個行程共用的
+# 背景執行緒。進度與串流中的報告寫回資料表，畫面每隔幾秒讀一次，重新整理瀏覽器也不會中斷；
+# 完成的報告存成該客戶的最新報告 (save_strategy)。業務可以連續替多位客戶送出分析。
+# 陪練室的對話摘要也在這裡背景更新，不佔用業務等待回覆的時間。
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from chat_context import summary_prompt
+from db import get_conn, save_strategy, save_summary
+from kb_store import get_kb
+from llm import generate_with_retry, stream_with_retry
+from metrics import span
+from prompts import build_analysis_prompt
+from proposal import extract_proposal_text
+
+JOB_WORKERS = 2              # 同時執行的分析數 (實際呼叫仍受排程器限速)
+PROGRESS_INTERVAL = 1.5      # 串流中最多每隔這麼多秒把目前內容寫回一次
+REPORT_CHARS = 4000         # 報告大約長度，用來估算串流進度
+
+_pool = None
+_pool_lock = threading.Lock()
+# 這個行程的識別碼；同一個 pid 重新啟動後識別碼不同，可分辨出上一次留下的工作
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+_summarizing = set()   # 摘要更新中的 (user_key, 客戶)，同一位客戶一次只跑一個
+
+
+def _pid_alive(pid):
+    if os.name == "nt": return True   # Windows 的 os.kill 會真的送出訊號，無法用來探測，一律視為還在
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: return True
+    return True
+
+
+def _owner_gone(owner):
+    # 同一台主機上 pid 已不存在，或 pid 相同但識別碼不同 (重新啟動) 才算結束；其他主機的工作不動
+    if not owner: return True   # v8 之前建立的工作
+    host, pid, _ = owner.rsplit(":", 2)
+    if host != socket.gethostname(): return False
+    if int(pid) == os.getpid(): return owner != OWNER
+    return not _pid_alive(int(pid))
+
+
+def _start():
+    # 第一次使用時建立執行緒池；已結束的行程留下沒做完的工作 (模型物件與 API Key 不落地) 標記為中斷，
+    # 同一個資料庫上其他還在執行的服務行程的工作保持原狀
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            conn = get_conn()
+            rows = conn.execute("SELECT id, owner FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+            stale = [(time.time(), job_id) for job_id, owner in rows if _owner_gone(owner)]
+            with conn:
+                conn.executemany('''UPDATE jobs SET status='failed', error='服務重新啟動，工作已中斷，請重新送出', finished_at=?
+                                    WHERE id=? AND status IN ('queued', 'running')''', stale)
+            _pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+        return _pool
+
+
+def _update(job_id, **fields):
+    conn = get_conn()
+    with conn:
+        conn.execute(f"UPDATE jobs SET {', '.join(f'{k}=?' for k in fields)} WHERE id=?", (*fields.values(), job_id))
+
+
+def submit_analysis(user_key, name, form_data, model, proposal=None, refresh=False):
+    # proposal 為上傳建議書的 bytes；回傳工作編號
+    pool = _start()
+    conn = get_conn()
+    with conn:
+        job_id = conn.execute('''INSERT INTO jobs (user_key, client_name, model, status, progress, note, payload, attachment, created_at, owner)
+                                 VALUES (?, ?, ?, 'queued', 0, '排隊中', ?, ?, ?, ?)''',
+                              (user_key, name, model.model_name, json.dumps({"form_data": form_data, "refresh": refresh}, default=str),
+                               proposal, time.time(), OWNER)).lastrowid
+    pool.submit(_run, job_id, model)
+    return job_id
+
+
+def _run(job_id, model):
+    row = get_conn().execute("SELECT user_key, client_name, payload, attachment FROM jobs WHERE id=?", (job_id,)).fetchone()
+    if not row: return
+    user_key, name, payload, attachment = row
+    payload = json.loads(payload)
+    _update(job_id, status="running", progress=0.05, note="解析建議書", started_at=time.time())
+    try:
+        with span("job.analysis", model.model_name):
+            proposal_text, note = "", ""
+            if attachment:
+                try:
+                    proposal_text, _ = extract_proposal_text(attachment)
+                    if not proposal_text: note = "⚠️ 無法讀取 PDF 內容，可能是圖片掃描檔，報告未對照建議書"
+                except Exception as e:
+                    note = f"⚠️ 讀取 PDF 失敗 ({type(e).__name__}: {e})，報告未對照建議書"
+            kb = get_kb()
+            _update(job_id, progress=0.15, note="組裝提示詞", proposal_text=proposal_text)
+            prompt = build_analysis_prompt(kb, payload["form_data"], model, proposal_text)
+
+            last = [0.0]
+            def on_text(text):
+                now = time.monotonic()
+                if now - last[0] < PROGRESS_INTERVAL: return
+                last[0] = now
+                _update(job_id, progress=min(0.95, 0.3 + 0.65 * len(text) / REPORT_CHARS), note="產生報告中", result=text)
+
+            # on_wait 只在排隊位置變動時呼叫，且排程器在鎖外呼叫，寫資料庫不會卡住其他 session
+            text = stream_with_retry(model, prompt, label="教練報告", cache_version=kb.version, refresh=payload.get("refresh", False),
+                                     on_text=on_text, on_wait=lambda pos: _update(job_id, note=f"排隊中：第 {pos} 位"))
+            save_strategy(user_key, name, text)
+        _update(job_id, status="done", progress=1.0, note=note or "完成", result=text, attachment=None, finished_at=time.time())
+    except Exception as e:
+        _update(job_id, status="failed", note="失敗", error=str(e), attachment=None, finished_at=time.time())
+
+
+def submit_summary(user_key, name, model, summary, older):
+    # 把 older (尚未摺入的較舊訊息) 摺進滾動摘要；同一位客戶已在更新時略過，下一輪再補
+    key = (user_key, name)
+    with _pool_lock:
+        if key in _summarizing: return False
+        _summarizing.add(key)
+    _start().submit(_summarize, key, model, summary, list(older))
+    return True
+
+
+def _summarize(key, model, summary, older):
+    # 失敗不影響對話 (舊訊息仍以原文放進提示詞)，記進效能指標的失敗次數，下一輪重試
+    try:
+        with span("job.summary", model.model_name):
+            res = generate_with_retry(model, summary_prompt(summary, older), label="對話摘要")
+            save_summary(*key, res.text, older[-1]["seq"])
+    except Exception:
+        pass
+    finally:
+        with _pool_lock:
+            _summarizing.discard(key)
+
+
+def _as_dict(cursor, row):
+    return {d[0]: v for d, v in zip(cursor.description, row)} if row else None
+
+
+def latest_job(user_key, name):
+    _start()
+    cur = get_conn().execute('''SELECT id, status, progress, note, result, error, proposal_text, seen FROM jobs
+                                WHERE user_key=? AND client_name=? ORDER BY id DESC LIMIT 1''', (user_key, name))
+    return _as_dict(cur, cur.fetchone())
+
+
+def job_counts(user_key):
+    # 側邊欄徽章：{"queued": n, "running": n, "done": 未確認的完成數, "failed": 未確認的失敗數}
+    _start()
+    rows = get_conn().execute('''SELECT status, COUNT(*) FROM jobs WHERE user_key=? AND (status IN ('queued', 'running') OR seen=0)
+                                 GROUP BY status''', (user_key,)).fetchall()
+    return dict(rows)
+
+
+def recent_jobs(user_key, limit=10):
+    cur = get_conn().execute('''SELECT id, client_name, status, progress, note, error, created_at, finished_at FROM jobs
+                                WHERE user_key=? ORDER BY id DESC LIMIT ?''', (user_key, limit))
+    return [_as_dict(cur, r) for r in cur.fetchall()]
+
+
+def mark_seen(user_key, name=None):
+    # 開啟客戶 (或按「清除」) 後，已結束的工作不再計入徽章
+    conn = get_conn()
+    with conn:
+        conn.execute(f'''UPDATE jobs SET seen=1 WHERE user_key=? AND status NOT IN ('queued', 'running')
+                         {"AND client_name=?" if name else ""}''', (user_key, name) if name else (user_key,))
@@ -0,0 +1,110 @@
+# --- 知識庫檢索索引 ---
+# 將 load_kb() 讀入的全文依手冊的 ----- 分隔線切段，
+# 以中文字元 bigram 建立倒排索引，用 BM25 挑出與查詢最相關、且塞得進預算的段落。
+import math
+import re
+from collections import Counter, defaultdict
+
+SECTION_SEP = re.compile(r'\n-{5,}\n')
+SOURCE_HEADER = re.compile(r'^=== (.+?) ===$', re.M)
+PRODUCT_TITLE = re.compile(r'^(.+?【[A-Z0-9]{3,}】)\s*$', re.M)
+CJK_RUN = re.compile(r'[㐀-鿿豈-﫿]+')
+WORD_RUN = re.compile(r'[A-Za-z0-9]+(?:\.[0-9]+)?')
+
+MIN_SECTION = 120    # 過短的段落 (如商品標題、類別) 併入下一段
+MAX_SECTION = 1500   # 無分隔線的內容 (Excel CSV) 依行切成此大小
+
+
+def tokenize(text):
+    # 中文取相鄰兩字 (單字詞則取單字)，英數取整個詞並轉小寫
+    tokens = []
+    for run in CJK_RUN.findall(text):
+        if len(run) == 1: tokens.append(run)
+        else: tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(w.lower() for w in WORD_RUN.findall(text))
+    return tokens
+
+
+def _split_long(text):
+    if len(text) <= MAX_SECTION: return [text]
+    chunks, buf, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        if size + len(line) > MAX_SECTION and buf:
+            chunks.append("".join(buf))
+            buf, size = [], 0
+        buf.append(line)
+        size += len(line)
+    if buf: chunks.append("".join(buf))
+    return chunks
+
+
+def split_sections(full_text):
+    # 回傳 [(標題, 段落內容)]；標題為所屬商品 (手冊) 或來源檔名，讓模型知道段落出處
+    sections = []
+    headers = list(SOURCE_HEADER.finditer(full_text))
+    for i, h in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(full_text)
+        source = h.group(1)
+        title, pending = source, ""
+        for part in SECTION_SEP.split(full_text[h.end():end]):
+            part = part.strip().strip('-').strip()
+            if not part: continue
+            m = PRODUCT_TITLE.match(part)
+            if m:
+                if pending: sections.append((title, pending))
+                title, pending = m.group(1).strip(), ""
+            pending = f"{pending}\n{part}" if pending else part
+            if len(pending) >= MIN_SECTION:
+                for chunk in _split_long(pending): sections.append((title, chunk))
+                pending = ""
+        if pending: sections.append((title, pending))
+    return sections
+
+
+class KBIndex:
+    def __init__(self, full_text, k1=1.5, b=0.75):
+        self.k1, self.b = k1, b
+        self.sections = split_sections(full_text or "")
+        self.postings = defaultdict(list)   # token -> [(段落序號, 詞頻)]
+        self.lengths = []
+        for doc_id, (title, body) in enumerate(self.sections):
+            counts = Counter(tokenize(f"{title}\n{body}"))
+            self.lengths.append(sum(counts.values()))
+            for tok, tf in counts.items(): self.postings[tok].append((doc_id, tf))
+        n = len(self.sections)
+        self.avg_len = (sum(self.lengths) / n) if n else 0
+        self.idf = {tok: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for tok, p in self.postings.items()}
+
+    def __len__(self):
+        return len(self.sections)
+
+    def search(self, query, k=20):
+        scores = defaultdict(float)
+        k1, b, avg = self.k1, self.b, self.avg_len or 1
+        for tok, qtf in Counter(tokenize(query)).items():
+            idf = self.idf.get(tok)
+            if idf is None: continue
+            for doc_id, tf in self.postings[tok]:
+                norm = tf + k1 * (1 - b + b * self.lengths[doc_id] / avg)
+                scores[doc_id] += qtf * idf * tf * (k1 + 1) / norm
+        return sorted(scores.items(), key=lambda x: -x[1])[:k]
+
+    def select(self, query, budget, k=40, exclude=()):
+        # 依分數由高到低放入段落，直到字數預算用完；同一商品的段落共用一個標題
+        # exclude：標題含這些字串的段落不選 (例如已經由商品目錄整段放入的商品代碼)
+        picked, used = [], 0
+        for doc_id, _ in self.search(query, k):
+            title, body = self.sections[doc_id]
+            if any(x in title for x in exclude): continue
+            cost = len(body) + len(title) + 8
+            if used + cost > budget: continue
+            picked.append(doc_id)
+            used += cost
+        picked.sort()
+        out, last_title = [], None
+        for doc_id in picked:
+            title, body = self.sections[doc_id]
+            if title != last_title: out.append(f"\n### {title}")
+            out.append(body)
+            last_title = title
+        return "\n".join(out).strip()
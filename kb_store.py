@@ -0,0 +1,172 @@
+# --- 知識庫共用快取 ---
+# 整個行程共用一份知識庫 (所有 Streamlit session 直接引用同一物件)，
+# 並把每個檔案的解析結果存成磁碟快照，以 (路徑, mtime, 大小, 內容雜湊) 判斷是否需要重新解析。
+# Excel 商品資料不放進全文，另存成給付表 (product_table.py)，提示詞依條件篩選後才放入。
+import hashlib
+import os
+import pickle
+import threading
+
+import pandas as pd
+
+from catalog import Catalog, parse_manual
+from kb_index import KBIndex
+from metrics import timed
+from product_table import ProductTable, load_table
+
+pdf_tool_ready = False
+try:
+    import pdfplumber
+    pdf_tool_ready = True
+except ImportError:
+    pdf_tool_ready = False
+
+CACHE_DIR = ".kb_cache"
+SNAPSHOT_FILE = os.path.join(CACHE_DIR, "kb_snapshot.pkl")
+SNAPSHOT_VERSION = 5
+
+
+class KnowledgeBase:
+    def __init__(self, files, debug):
+        self.files = files          # {路徑: 檔案紀錄}，依讀取順序
+        self.debug = debug
+        self.text = "".join(rec["text"] for rec in files.values())
+        self.count = len(files)
+        self.version = hashlib.sha1("|".join(f"{p}:{rec['sha']}" for p, rec in files.items()).encode()).hexdigest()[:12]
+        self.index = KBIndex(self.text)
+        self.catalog = Catalog([p for rec in files.values() for p in rec.get("products", [])])
+        self.products = ProductTable(self._load_tables(), self.catalog)
+
+    def _load_tables(self):
+        # 單一 Excel 讀不進來只記錄、略過，不影響其他檔案與整個知識庫
+        tables = []
+        for path, rec in self.files.items():
+            if not _is_excel(path): continue
+            try:
+                tables.append(load_table(path, rec["sha"]))
+            except Exception as e:
+                self.debug.append(f"❌ Excel Error {path}: {e}")
+        return tables
+
+
+_kb = None
+_kb_lock = threading.Lock()
+
+
+# --- 單檔解析 ---
+def _file_sha(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""): h.update(block)
+    return h.hexdigest()
+
+
+def _is_excel(f):
+    return f.lower().endswith(('.xlsx', '.xlsm'))
+
+
+def _parse_excel(f):
+    # 內容由 KnowledgeBase 以 load_table 讀成給付表，這裡只檢查第一個工作表有「商品代碼」欄；
+    # 其他活頁簿丟出例外，由 scan_kb 記為錯誤且不列入知識庫
+    with pd.ExcelFile(f, engine='openpyxl') as book:
+        header = book.parse(book.sheet_names[0], nrows=0)
+    if "商品代碼" not in header.columns: raise ValueError("第一個工作表沒有「商品代碼」欄，不是商品資料表")
+    return "", f"✅ Excel: {f}"
+
+
+def _parse_txt(f):
+    try:
+        with open(f, "r", encoding="utf-8") as file:
+            return f"\n=== 手冊內容 ({f}) ===\n{file.read()}\n", f"✅ TXT: {f}"
+    except UnicodeDecodeError:
+        with open(f, "r", encoding="cp950") as file:
+            return f"\n=== 手冊內容 ({f}) ===\n{file.read()}\n", f"✅ TXT(Big5): {f}"
+
+
+@timed("kb.parse_pdf")
+def _parse_pdf(f):
+    with pdfplumber.open(f) as pdf:
+        text = "".join([p.extract_text() or "" for p in pdf.pages])
+    return f"\n=== PDF手冊 ({f}) ===\n{text}\n", f"✅ PDF: {f}"
+
+
+def _list_sources(all_files):
+    # 讀取順序與原本相同：Excel → TXT → PDF
+    names = sorted(all_files)
+    sources = [(f, _parse_excel, "Excel") for f in names if _is_excel(f)]
+    sources += [(f, _parse_txt, "TXT") for f in names if f.lower().endswith('.txt') and "requirements" not in f]
+    if pdf_tool_ready:
+        sources += [(f, _parse_pdf, "PDF") for f in names if f.lower().endswith('.pdf')]
+    return sources
+
+
+# --- 快照 ---
+def _load_snapshot():
+    try:
+        with open(SNAPSHOT_FILE, "rb") as fh:
+            snap = pickle.load(fh)
+        if snap.get("version") == SNAPSHOT_VERSION: return snap
+    except Exception:
+        pass
+    return {"version": SNAPSHOT_VERSION, "files": {}}
+
+
+def _save_snapshot(files):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = SNAPSHOT_FILE + ".tmp"
+        with open(tmp, "wb") as fh:
+            pickle.dump({"version": SNAPSHOT_VERSION, "files": files}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, SNAPSHOT_FILE)
+    except OSError:
+        pass
+
+
+@timed("kb.load")
+def scan_kb(previous=None):
+    # 增量掃描：mtime 與大小未變就直接沿用；有變動時再比對內容雜湊，雜湊不同才重新解析
+    old = previous if previous is not None else _load_snapshot()["files"]
+    all_files = os.listdir('.')
+    debug_log = [f"📂 目錄: {all_files}"]
+    files, changed = {}, False
+    for f, parser, kind in _list_sources(all_files):
+        try:
+            st_ = os.stat(f)
+            rec = old.get(f)
+            if rec and rec["mtime"] == st_.st_mtime and rec["size"] == st_.st_size:
+                files[f] = rec
+                debug_log.append(f"{rec['log']} (快取)")
+                continue
+            sha = _file_sha(f)
+            if rec and rec["sha"] == sha:
+                rec = dict(rec, mtime=st_.st_mtime, size=st_.st_size)
+                debug_log.append(f"{rec['log']} (快取)")
+            else:
+                text, log = parser(f)
+                rec = {"mtime": st_.st_mtime, "size": st_.st_size, "sha": sha, "text": text, "log": log}
+                # 商品手冊另外解析成商品目錄，隨快照一起保存，下次不必重新解析
+                if kind == "TXT": rec["products"] = parse_manual(text)
+                debug_log.append(log)
+            files[f] = rec
+            changed = True
+        except Exception as e:
+            debug_log.append(f"❌ {kind} Error {f}: {e}")
+    if changed or set(files) != set(old): _save_snapshot(files)
+    return KnowledgeBase(files, debug_log)
+
+
+def get_kb():
+    # 第一次呼叫時載入 (優先讀快照)，之後所有 session 直接拿到同一個物件
+    global _kb
+    if _kb is None:
+        with _kb_lock:
+            if _kb is None: _kb = scan_kb()
+    return _kb
+
+
+def refresh_kb():
+    # 「🔄 重掃」：只重新解析有變動的檔案，完成後整份替換
+    global _kb
+    with _kb_lock:
+        _kb = scan_kb(_kb.files if _kb is not None else None)
+    return _kb
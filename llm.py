@@ -0,0 +1,154 @@
+# --- Gemini 呼叫 ---
+# 一般呼叫與串流呼叫都經過共用排程器 (scheduler.py) 排隊與限速；遇到 429 時依建議秒數
+# 或指數退避暫停該模型後再試。
+# 串流只在第一段文字出來之前重試，已經輸出內容後出錯就直接拋出，避免畫面重複。
+# 傳入 cache_version (知識庫版本) 時會先查回應快取；refresh=True 則略過快取重新產生並覆寫。
+# 每次呼叫記一筆 llm.<label> (含排隊、重試的總時間與 token 數)，每次排隊另記 llm.wait (見 metrics.py)。
+import threading
+import time
+from collections import deque
+
+from metrics import record, span
+from response_cache import cache_key, get_cached, put_cached
+from scheduler import (MAX_ATTEMPTS, backoff_delay, estimate_tokens, is_rate_limited, model_name, retry_after,
+                       scheduler)
+
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+# 最近呼叫的耗時紀錄 (整個行程共用)：首字時間 ttft 與總時間 total，單位秒
+call_log = deque(maxlen=200)
+_call_log_lock = threading.Lock()
+
+
+def record_call(label, model_name, total, ttft=None, stream=False, cached=False):
+    with _call_log_lock:
+        call_log.append({"label": label, "model": model_name, "stream": stream, "cached": cached,
+                         "ttft": ttft, "total": total, "at": time.time()})
+
+
+def recent_calls(label=None):
+    with _call_log_lock:
+        return [c for c in call_log if label is None or c["label"] == label]
+
+
+class CachedResponse:
+    # 與 SDK 回應物件相同，只用到 .text
+    def __init__(self, text):
+        self.text = text
+
+
+def _from_cache(model, prompt, label, cache_version, refresh):
+    if cache_version is None: return None, None
+    key = cache_key(model_name(model), prompt, cache_version)
+    if refresh: return key, None
+    start = time.perf_counter()
+    text = get_cached(key)
+    if text is not None:
+        elapsed = time.perf_counter() - start
+        record_call(label, model_name(model), elapsed, ttft=elapsed, cached=True)
+        record("llm.cache_hit", elapsed, model_name(model))
+    return key, text
+
+
+def _usage(res, prompt, text):
+    # (輸入 token, 輸出 token)：優先用 API 回傳的 usage_metadata，沒有就粗估
+    meta = getattr(res, "usage_metadata", None)
+    return (getattr(meta, "prompt_token_count", None) or estimate_tokens(prompt),
+            getattr(meta, "candidates_token_count", None) or estimate_tokens(text))
+
+
+def _on_rate_limit(model, attempt, exc):
+    if not is_rate_limited(exc):
+        scheduler.failed()
+        raise exc
+    scheduler.throttled(model_name(model), backoff_delay(attempt, retry_after(exc)))
+
+
+def generate_with_retry(model, prompt, label="generate", cache_version=None, refresh=False, on_wait=None):
+    # on_wait(排隊位置)：排隊等待時呼叫，讓畫面顯示目前排在第幾位
+    key, text = _from_cache(model, prompt, label, cache_version, refresh)
+    if text is not None: return CachedResponse(text)
+    tokens = estimate_tokens(prompt)
+    with span(f"llm.{label}", model_name(model)) as s:
+        s["prompt_tokens"] = tokens
+        for attempt in range(MAX_ATTEMPTS):
+            s["retries"] = attempt
+            queued = time.perf_counter()
+            with scheduler.slot(model_name(model), tokens, on_wait):
+                start = time.perf_counter()
+                record("llm.wait", start - queued, model_name(model))
+                try:
+                    res = model.generate_content(prompt, safety_settings=SAFETY_SETTINGS)
+                    if res.text:
+                        elapsed = time.perf_counter() - start
+                        record_call(label, model_name(model), elapsed, ttft=elapsed)
+                        s["prompt_tokens"], s["response_tokens"] = _usage(res, prompt, res.text)
+                        if key: put_cached(key, model_name(model), res.text)
+                        return res
+                except Exception as e:
+                    _on_rate_limit(model, attempt, e)
+        scheduler.failed()
+        raise Exception("API Error")
+
+
+def _chunk_text(chunk):
+    # 被安全機制擋下或沒有內容的片段，.text 會丟 ValueError
+    try: return chunk.text
+    except ValueError: return ""
+
+
+def _empty_reason(chunk):
+    # 串流結束卻沒有任何文字 (通常是被安全機制擋下)：從最後一段取出原因
+    feedback = getattr(chunk, "prompt_feedback", None)
+    candidates = getattr(chunk, "candidates", None) or []
+    details = [f"{k}={v}" for k, v in (("block_reason", getattr(feedback, "block_reason", None)),
+                                        ("finish_reason", getattr(candidates[0], "finish_reason", None) if candidates else None)) if v]
+    return f"模型沒有回傳內容 ({', '.join(details)})" if details else "模型沒有回傳內容"
+
+
+def stream_with_retry(model, prompt, on_text=None, label="stream", cache_version=None, refresh=False, on_wait=None):
+    # on_text(目前累積的全文)：每收到一段就呼叫一次，用來即時更新畫面；回傳完整文字
+    key, text = _from_cache(model, prompt, label, cache_version, refresh)
+    if text is not None:
+        if on_text: on_text(text)
+        return text
+    tokens = estimate_tokens(prompt)
+    with span(f"llm.{label}", model_name(model)) as s:
+        s["prompt_tokens"] = tokens
+        for attempt in range(MAX_ATTEMPTS):
+            s["retries"] = attempt
+            queued = time.perf_counter()
+            with scheduler.slot(model_name(model), tokens, on_wait):
+                start = time.perf_counter()
+                record("llm.wait", start - queued, model_name(model))
+                ttft, parts, chunk = None, [], None
+                try:
+                    for chunk in model.generate_content(prompt, safety_settings=SAFETY_SETTINGS, stream=True):
+                        piece = _chunk_text(chunk)
+                        if not piece: continue
+                        if ttft is None: ttft = time.perf_counter() - start
+                        parts.append(piece)
+                        if on_text: on_text("".join(parts))
+                except Exception as e:
+                    if parts:
+                        scheduler.failed()
+                        raise e
+                    _on_rate_limit(model, attempt, e)
+                    continue
+                # 只有第一段之前的限流錯誤會重試；被擋下或空白的回應重送也一樣，直接回報原因
+                if not parts:
+                    scheduler.failed()
+                    raise ValueError(_empty_reason(chunk))
+                record_call(label, model_name(model), time.perf_counter() - start, ttft=ttft, stream=True)
+                text = "".join(parts)
+                # 串流的 usage_metadata 在最後一段
+                s["prompt_tokens"], s["response_tokens"] = _usage(chunk, prompt, text)
+                if key: put_cached(key, model_name(model), text)
+                return text
+        scheduler.failed()
+        raise Exception("API Error")
@@ -0,0 +1,104 @@
+# --- 效能量測 ---
+# 在各階段 (知識庫載入、資料庫存取、PDF 解析、模型清單、提示詞組裝、Gemini 呼叫) 包一層計時，
+# 連同 token 數與重試次數先放在記憶體緩衝，累積一批或每隔幾秒才一次寫進 SQLite 的 metrics 資料表，
+# 不在每次呼叫時寫檔。側邊欄的「📈 效能指標」依階段與模型顯示 p50/p95。
+import atexit
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+import pandas as pd
+
+FLUSH_SIZE = 50          # 緩衝累積到這麼多筆就寫入
+FLUSH_INTERVAL = 5.0     # 或距離上次寫入超過這麼多秒
+BUFFER_MAX = 5000        # 資料庫一直寫不進去時最多保留這麼多筆，避免吃光記憶體
+KEEP_DAYS = 14
+
+_buffer = deque(maxlen=BUFFER_MAX)
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def record(stage, duration, model=None, prompt_tokens=None, response_tokens=None, retries=0, ok=True):
+    # duration 單位秒
+    global _last_flush
+    with _lock:
+        _buffer.append((time.time(), stage, model, duration * 1000, prompt_tokens, response_tokens, retries, int(ok)))
+        due = len(_buffer) >= FLUSH_SIZE or time.monotonic() - _last_flush >= FLUSH_INTERVAL
+    if due: flush()
+
+
+@contextmanager
+def span(stage, model=None):
+    # 用法：with span("llm.generate", model_name) as s: ...; s["retries"] = 2
+    # 區塊內丟出例外時記為失敗 (ok=False) 再往外拋
+    info = {"model": model, "prompt_tokens": None, "response_tokens": None, "retries": 0, "ok": True}
+    start = time.perf_counter()
+    try:
+        yield info
+    except BaseException:
+        info["ok"] = False
+        raise
+    finally:
+        record(stage, time.perf_counter() - start, **info)
+
+
+def timed(stage):
+    # 裝飾器版本，函式不需要回報 token 數時使用
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def flush():
+    global _last_flush
+    from db import get_conn
+    if not _flush_lock.acquire(blocking=False): return   # 其他執行緒正在寫
+    try:
+        with _lock:
+            rows = list(_buffer)
+            _buffer.clear()
+            _last_flush = time.monotonic()
+        if not rows: return
+        try:
+            conn = get_conn()
+            with conn:
+                conn.executemany('''INSERT INTO metrics (at, stage, model, duration_ms, prompt_tokens, response_tokens, retries, ok)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+                conn.execute("DELETE FROM metrics WHERE at < ?", (time.time() - KEEP_DAYS * 86400,))
+        except sqlite3.Error:
+            with _lock:
+                _buffer.extendleft(reversed(rows))   # 下次再試
+    finally:
+        _flush_lock.release()
+
+
+def latency_summary(hours=24):
+    # 各階段、各模型的呼叫數與 p50/p95 (毫秒)；先把緩衝寫入，畫面上才看得到最新的紀錄
+    from db import get_conn
+    flush()
+    df = pd.read_sql_query('''SELECT stage, COALESCE(model, '') AS model, duration_ms, prompt_tokens, response_tokens, retries, ok
+                              FROM metrics WHERE at >= ?''', get_conn(), params=(time.time() - hours * 3600,))
+    if df.empty: return df
+    g = df.groupby(["stage", "model"])
+    summary = pd.DataFrame({
+        "次數": g.size(),
+        "p50(ms)": g["duration_ms"].quantile(0.5).round(1),
+        "p95(ms)": g["duration_ms"].quantile(0.95).round(1),
+        "平均輸入token": g["prompt_tokens"].mean().round(0),
+        "平均輸出token": g["response_tokens"].mean().round(0),
+        "重試": g["retries"].sum(),
+        "失敗": g.size() - g["ok"].sum(),
+    }).reset_index().rename(columns={"stage": "階段", "model": "模型"})
+    return summary.sort_values("p95(ms)", ascending=False, ignore_index=True)
+
+
+atexit.register(flush)
@@ -0,0 +1,80 @@
+# --- 模型清單與模型物件快取 ---
+# list_models() 要連網，原本每次 rerun 都會呼叫一次。這裡依 API Key 快取可用模型清單 (有 TTL，
+# 也可手動刷新)，GenerativeModel 物件也依 (Key, 模型名稱) 共用，rerun 沒動到模型就完全不連網。
+# 各模型的輸入 token 上限順便從清單記下來，提示詞預算 (prompts.py) 依此分配。
+import hashlib
+import threading
+import time
+
+import google.generativeai as genai
+
+from metrics import span
+from scheduler import model_name, pick_by_model
+
+MODEL_LIST_TTL = 3600
+# 查不到模型規格時 (離線、測試用的假模型) 依名稱關鍵字估計的輸入 token 上限
+DEFAULT_INPUT_LIMITS = {"flash": 1_000_000, "pro": 2_000_000, "default": 32_768}
+
+_lock = threading.Lock()
+_model_lists = {}     # key 指紋 -> (到期時間, [模型名稱])
+_instances = {}       # (key 指紋, 模型名稱) -> GenerativeModel
+_configured = None    # 目前 genai.configure 用的 key 指紋
+_input_limits = {}    # 模型名稱 -> 輸入 token 上限 (模型規格與 Key 無關)
+
+
+def _fingerprint(api_key):
+    # 只存雜湊，避免 API Key 原文留在記憶體中的快取鍵
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+def _configure(api_key):
+    global _configured
+    fp = _fingerprint(api_key)
+    if _configured != fp:
+        genai.configure(api_key=api_key)
+        _configured = fp
+    return fp
+
+
+def list_generation_models(api_key, refresh=False, ttl=MODEL_LIST_TTL):
+    # 支援 generateContent 的模型，1.5-flash 排最前面 (與原本排序相同)
+    with _lock:
+        fp = _configure(api_key)
+        cached = _model_lists.get(fp)
+        if cached and not refresh and cached[0] > time.time(): return cached[1]
+    # 網路呼叫不持有鎖，避免其他執行緒取模型或查輸入上限時一起卡住；鎖只用來更新快取
+    with span("models.list"):
+        models = [m for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
+    names = [m.name for m in models]
+    names.sort(key=lambda x: "1.5-flash" not in x.lower())
+    with _lock:
+        _input_limits.update({m.name: m.input_token_limit for m in models if getattr(m, "input_token_limit", None)})
+        _model_lists[fp] = (time.time() + ttl, names)
+    return names
+
+
+def get_model(api_key, model_name):
+    with _lock:
+        fp = _configure(api_key)
+        model = _instances.get((fp, model_name))
+        if model is None:
+            model = _instances[(fp, model_name)] = genai.GenerativeModel(model_name)
+        return model
+
+
+def input_token_limit(model):
+    # 清單裡有就直接用，否則查一次 genai.get_model 並快取；都查不到依名稱估計
+    name = model_name(model)
+    with _lock:
+        if name in _input_limits: return _input_limits[name]
+    limit = None
+    if isinstance(model, genai.GenerativeModel):
+        try:
+            with span("models.get", name):
+                limit = genai.get_model(name).input_token_limit
+        except Exception:
+            pass
+    if not limit: limit = pick_by_model(DEFAULT_INPUT_LIMITS, name)
+    with _lock:
+        _input_limits[name] = limit
+    return limit
@@ -0,0 +1,132 @@
+# --- 商品給付表 ---
+# 修改版商品資料.xlsm 解析成有型別的表格 (每個商品一列、每項給付一欄)，以 Parquet 存在 .kb_cache，
+# 依檔案內容雜湊命名，檔案變動後自動重建。提示詞不再塞整張 CSV，只放依缺口類別、年齡、幣別篩出的幾列。
+import glob
+import hashlib
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = ".kb_cache"
+TABLE_VERSION = 1
+
+# 缺口項目 (與 coverage.py 的項目名稱相同) -> 給付欄位
+CATEGORY_COLUMNS = {
+    "住院日額": ["住院日額合計", "加護病房合計"],
+    "醫療實支": ["住院雜費上限", "住院手術實支實付", "門診手術實支實付"],
+    "定額手術": ["住院手術定額", "門診手術定額"],
+    "意外實支": ["意外雜費", "意外住院日額合計", "意外住院手術定額", "骨折未住院"],
+    "癌症一筆金": ["初次罹癌"],
+    "重大一筆金": ["重大疾病一次"],
+    "放療": ["癌症放化療"],
+    "化療": ["癌症放化療"],
+    "長照月給付": ["長照疾病一次", "長照意外一次", "疾病長照狀態每月", "意外長照狀態每月", "疾病認知障礙每月"],
+    "失能月給付": ["疾病特傷每月", "意外特傷每月", "疾病1-3每月", "疾病4-6每月", "意外1-3每月", "意外4-6每月"],
+}
+
+AGE_RANGE = re.compile(r'(\d{1,2})\s*(?:足?歲)?\s*[~～\-－至]\s*(\d{1,3})\s*歲?')
+
+
+def _cache_prefix(path):
+    return os.path.join(CACHE_DIR, f"products_{hashlib.sha1(path.encode()).hexdigest()[:8]}_")
+
+
+def _cache_path(path, sha):
+    return f"{_cache_prefix(path)}v{TABLE_VERSION}_{sha[:16]}.parquet"
+
+
+def _read_excel(path):
+    # 第一個工作表為每單位給付數字，第二個工作表 (若有) 為各欄備註
+    sheets = pd.read_excel(path, sheet_name=None, engine='openpyxl')
+    frames = list(sheets.values())
+    table = frames[0].dropna(subset=["商品代碼"])
+    table["商品代碼"] = table["商品代碼"].astype(str).str.strip()
+    benefit_cols = [c for c in table.columns if c != "商品代碼"]
+    table[benefit_cols] = table[benefit_cols].apply(pd.to_numeric, errors="coerce").fillna(0.0)
+    table["備註"] = ""
+    if len(frames) > 1 and "商品代碼" in frames[1].columns:
+        notes = frames[1].dropna(subset=["商品代碼"]).set_index("商品代碼").drop(columns=["基準數"], errors="ignore")
+        joined = notes.apply(lambda row: "；".join(f"{k}：{str(v).strip('[]').replace('][', '、')}" for k, v in row.dropna().items()), axis=1)
+        # 同一代碼可能有多列備註，合併並去掉重複的項目
+        joined = joined[joined != ""].groupby(level=0).agg(lambda v: "；".join(dict.fromkeys(p for s in v for p in s.split("；"))))
+        table["備註"] = table["商品代碼"].map(joined).fillna("")
+    return table.reset_index(drop=True)
+
+
+def load_table(path, sha):
+    # 同一份檔案 (雜湊相同) 直接讀 Parquet；讀不到或檔案已變動才重新解析 Excel 並清掉舊檔
+    cached = _cache_path(path, sha)
+    try:
+        return pd.read_parquet(cached)
+    except Exception:
+        pass
+    table = _read_excel(path)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        for old in glob.glob(_cache_prefix(path) + "*.parquet"): os.remove(old)
+        tmp = cached + ".tmp"
+        table.to_parquet(tmp, index=False)
+        os.replace(tmp, cached)
+    except Exception:
+        # 快取寫不進去 (無法寫入、缺 pyarrow、欄位型別不支援) 只是下次再解析一次
+        pass
+    return table
+
+
+def _age_range(text):
+    # 從「承保年齡」段落取出最小與最大投保年齡；讀不到回傳 (NaN, NaN)
+    pairs = [(int(a), int(b)) for a, b in AGE_RANGE.findall(text or "") if int(a) <= int(b) <= 120]
+    if not pairs: return np.nan, np.nan
+    return min(a for a, _ in pairs), max(b for _, b in pairs)
+
+
+class ProductTable:
+    def __init__(self, tables, catalog=None):
+        # tables：各 Excel 解析出的表格；catalog (商品手冊) 用來補上名稱、幣別與承保年齡
+        frame = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=["商品代碼", "基準數", "備註"])
+        frame = frame.drop_duplicates("商品代碼", keep="last").reset_index(drop=True)
+        products = catalog.products if catalog is not None else {}
+        info = [products.get(code) for code in frame["商品代碼"]]
+        frame["商品名稱"] = [p["name"] if p else "" for p in info]
+        frame["幣別"] = ["美元" if p and "美元" in p["name"] + p["sections"].get("類別", "") else "新臺幣" for p in info]
+        ages = [_age_range(p["sections"].get("繳費年期及承保年齡")) if p else (np.nan, np.nan) for p in info]
+        frame["最低年齡"] = pd.array([a for a, _ in ages], dtype="Float64")
+        frame["最高年齡"] = pd.array([b for _, b in ages], dtype="Float64")
+        self.frame = frame
+
+    def __len__(self):
+        return len(self.frame)
+
+    def filter(self, categories=None, age=None, currency=None):
+        # categories：缺口項目清單 (任一項有給付即符合)；age：年齡或 (最小, 最大)；currency：「新臺幣」/「美元」
+        # 手冊查不到承保年齡的商品不因年齡被排除
+        f = self.frame
+        mask = pd.Series(True, index=f.index)
+        if categories:
+            cols = sorted({c for cat in categories for c in CATEGORY_COLUMNS.get(cat, []) if c in f.columns})
+            mask &= (f[cols] > 0).any(axis=1) if cols else False
+        if age is not None:
+            lo, hi = age if isinstance(age, tuple) else (age, age)
+            mask &= ~((f["最低年齡"] > hi) | (f["最高年齡"] < lo)).fillna(False)
+        if currency:
+            mask &= f["幣別"] == currency
+        return f[mask]
+
+    def rows(self, codes):
+        # 指定代碼的商品 (依傳入順序)
+        f = self.frame.set_index("商品代碼", drop=False)
+        return f.loc[[c for c in codes if c in f.index]].reset_index(drop=True)
+
+    def render(self, rows, categories=None, limit=15):
+        # 精簡表格：每個商品一行，只列出所選類別中有給付的欄位
+        if rows is None or not len(rows): return ""
+        cols = [c for cat in (categories or CATEGORY_COLUMNS) for c in CATEGORY_COLUMNS.get(cat, [])]
+        cols = [c for c in dict.fromkeys(cols) if c in rows.columns]
+        lines = ["| 代碼 | 名稱 | 幣別 | 承保年齡 | 基準數 | 給付 (每基準數) | 備註 |", "|---|---|---|---|---|---|---|"]
+        for _, r in rows.head(limit).iterrows():
+            ages = f"{r['最低年齡']:.0f}~{r['最高年齡']:.0f}" if pd.notna(r["最低年齡"]) else "-"
+            benefits = "、".join(f"{c} {r[c]:g}" for c in cols if r[c] > 0)
+            lines.append(f"| {r['商品代碼']} | {r['商品名稱'] or '-'} | {r['幣別']} | {ages} | {r['基準數']:,.10g} | {benefits} | {r['備註'] or '-'} |")
+        return "\n".join(lines)
@@ -0,0 +1,175 @@
+# --- 教練分析提示詞 ---
+# app.py 與批次分析 (batch.py) 共用，確保兩邊產生的報告一致。
+import datetime
+import json
+import os
+import re
+
+import pandas as pd
+
+from chat_context import TokenCounter, trim_to_tokens
+from coverage import gap_table, short_items
+from metrics import timed
+from model_registry import input_token_limit
+from scheduler import model_name
+
+# 分析提示詞最多用到模型輸入上限的這個比例 (再扣掉留給報告輸出的額度)，模型越大可放的內容越多
+INPUT_SHARE = 0.5
+OUTPUT_RESERVE = 8192      # 留給報告輸出的額度
+# 成本上限：每次分析最多使用的輸入 token，依完整模型名稱設定 (版本後綴如 -002、-latest 視為同一模型)；
+# 1.5 系列提示詞超過 128k token 單價加倍。沒列出的模型只受上面的比例限制。
+# 可用環境變數 GEMINI_PROMPT_CAPS 覆寫，例如 {"models/gemini-1.5-pro": 64000}
+DEFAULT_COST_CAPS = {
+    "models/gemini-1.5-flash": 128_000,
+    "models/gemini-1.5-flash-8b": 128_000,
+    "models/gemini-1.5-pro": 128_000,
+}
+MODEL_VERSION = re.compile(r'-(?:latest|\d{3})$')
+# 扣掉指示與客戶資料 (必放) 後，各段依優先順序最多可用的比例；用不完的留給後面，剩下的全給知識庫
+PROPOSAL_SHARE = 0.40
+BENEFIT_SHARE = 0.10
+PRODUCT_SHARE = 0.25
+
+MARS_STANDARDS = {
+    "住院日額": "4000元", "醫療實支實付": "20萬", "定額手術": "1000", 
+    "意外實支實付": "10萬", "癌症一筆金": "50萬", "重大一筆金": "30萬", 
+    "放療": "3000", "化療": "3000", 
+    "長照月給付": "3萬", "失能月給付": "3萬", "壽險": "5倍年薪"
+}
+
+
+def calculate_life_path_number(birth_text):
+    digits = re.findall(r'\d', str(birth_text))
+    if not digits: return 0
+    total = sum(int(digit) for digit in "".join(digits))
+    while total > 9: total = sum(int(digit) for digit in str(total))
+    return total
+
+
+def client_age(birth_text, today=None):
+    # 出生年取頭尾的 4 位數 (西元，如 1985-03-02、03/02/1985)，否則開頭的 2~3 位數視為民國年 (74/3/2)；
+    # 連寫的 19850302、0740302 取前段。讀不到或年齡不合理時回傳 None
+    parts = re.findall(r'\d+', str(birth_text))
+    if not parts: return None
+    ends = [parts[0], parts[-1]]
+    if len(parts) == 1 and len(parts[0]) >= 6: ends = [parts[0][:-4]]
+    year = next((int(p) for p in ends if len(p) == 4), None)
+    if year is None and 2 <= len(ends[0]) <= 3: year = int(ends[0]) + 1911
+    if year is None: return None
+    age = (today or datetime.date.today()).year - year
+    return age if 0 <= age <= 120 else None
+
+
+def product_rows(kb, form_data):
+    # 給付表中銷售方針提到的商品，加上能補缺口、符合年齡與幣別的商品 (商品資料表讀不到時為空)
+    target = form_data.get("target_product", "") or ""
+    mentioned = kb.products.rows([p["code"] for p in kb.catalog.find_mentions(target)])
+    matched = kb.products.filter(short_items(form_data), age=client_age(form_data.get("birthday", "")),
+                                 currency="美元" if "美元" in target else None)
+    return pd.concat([mentioned, matched], ignore_index=True).drop_duplicates("商品代碼")
+
+
+def _load_cost_caps():
+    caps = dict(DEFAULT_COST_CAPS)
+    try: caps.update(json.loads(os.environ.get("GEMINI_PROMPT_CAPS", "{}")))
+    except ValueError: pass
+    return caps
+
+
+COST_CAPS = _load_cost_caps()
+
+
+def analysis_budget(model):
+    # 依模型的輸入 token 上限分配，再套用成本上限表
+    budget = int(input_token_limit(model) * INPUT_SHARE) - OUTPUT_RESERVE
+    name = model_name(model)
+    cap = COST_CAPS.get(name, COST_CAPS.get(MODEL_VERSION.sub("", name)))
+    return max(1000, min(budget, cap) if cap else budget)
+
+
+def _trim_rows(table, tokens, counter):
+    # Markdown 表格從最後一列往前刪，表頭兩行一定保留；只剩表頭時回傳空字串
+    lines = table.split("\n")
+    while len(lines) > 2 and counter.count("\n".join(lines)) > tokens: lines.pop()
+    return "\n".join(lines) if len(lines) > 2 else ""
+
+
+@timed("prompt.build")
+def build_analysis_prompt(kb, form_data, model, proposal_text=""):
+    # form_data 為表單欄位 (與存進 clients.data 的內容相同)；model 為模型物件或名稱，依它的 token 上限分配各段
+    f = lambda k: form_data.get(k, "") or ""
+    target_product, job, interests = f("target_product"), f("job"), f("interests")
+    # 現有保障的缺口在本機算好 (coverage.py)，模型只需引用，不必自己換算單位與加減
+    sections = {
+        "target_product": target_product, "client_name": f("name"), "job": job, "income": f("income"), "quotes": f("quotes"),
+        "life_path_num": calculate_life_path_number(f("birthday")), "coverage_table": gap_table(form_data),
+        "proposal_context": "", "product_context": "", "benefit_table": "", "kb_context": "",
+    }
+    fixed = _render(**sections)
+
+    # 指示與客戶資料必放；其餘依 建議書 > 給付表 > 指定及白名單商品 > 知識庫 的順序分配剩下的額度
+    counter = TokenCounter(model)
+    counter.calibrate(fixed + proposal_text[:2000])
+    room = max(0, analysis_budget(model) - counter.count(fixed))
+    left = room
+    if proposal_text:
+        proposal_text = trim_to_tokens(proposal_text, min(int(room * PROPOSAL_SHARE), left), counter)
+        if proposal_text: sections["proposal_context"] = f"\n【📄 上傳建議書內容 (After)】\n{proposal_text}\n"
+        left -= counter.count(sections["proposal_context"])
+    # 給付表只放符合條件的幾列，不再把整張 Excel 轉成文字
+    benefit_table = kb.products.render(product_rows(kb, form_data), short_items(form_data) or None)
+    sections["benefit_table"] = _trim_rows(benefit_table, min(int(room * BENEFIT_SHARE), left), counter)
+    left -= counter.count(sections["benefit_table"])
+    product_chars = counter.chars_for(min(int(room * PRODUCT_SHARE), left), sample=fixed)
+    sections["product_context"], product_marks = kb.catalog.context(target_product, ["壽險", "長照失能"], product_chars)
+    left -= counter.count(sections["product_context"])
+    kb_query = " ".join([target_product, job, interests, sections["quotes"], f("history_note")])
+    sections["kb_context"] = kb.index.select(kb_query, counter.chars_for(max(0, left), sample=fixed), exclude=product_marks)
+    return _render(**sections)
+
+
+def _render(target_product, client_name, life_path_num, job, income, quotes, coverage_table,
+            proposal_context, product_context, benefit_table, kb_context):
+    # ★★★ 關鍵 Prompt：直球對決表格 + 防呆 + 白名單 ★★★
+    return f"""
+    你是「教練 Coach Mars Chang」。
+    請依據【銷售方針】："{target_product}" 進行分析。
+    
+    【戰略 1：表格直球對決 (Strict Table)】
+    請製作一個簡潔表格，直接對照是否達標。***不要列出詳細算式，只要給出總額。***
+    欄位：[檢核項目]、[Mars標準]、[總保障額度 (Before+After)]、[達標狀態]
+    1. [達標狀態] 請用：✅ 達標 / ⚠️ 未達標 (缺口金額)
+    2. [總保障額度] = 下方【現有保障缺口表】的 [現有保障] + 建議書中的 [建議書補強]。若無建議書，直接沿用缺口表的數字與狀態。
+    3. 【現有保障缺口表】已由系統依以下標準算好，請直接引用，不要重算：
+       {json.dumps(MARS_STANDARDS, ensure_ascii=False)}
+    
+    【戰略 2：數據防呆 (Sanity Check)】
+    請仔細過濾 PDF 數據，**嚴禁抓取保費**：
+    - **日額/手術/放化療**：僅抓取「元/日」或「元/次」。若看到非整數或過小的數字(如 786)，那是保費，忽略它。
+    - **癌症/重大**：僅抓取「一次金」額度。嚴禁把日額混入。
+    - **意外**：僅抓取「實支實付」額度。忽略身故金。
+    - **醫療實支**：請抓取「住院醫療費用限額」(雜費)。
+    
+    【戰略 3：嚴格白名單】
+    - **壽險**：僅推美元或鑫鑫向榮。
+    - **長照/失能**：僅推「享放心、享安心、享順心、心安心」。絕對禁止用壽險充當。
+    
+    【客戶資料】
+    {client_name}, {life_path_num} 號人, {job}, 年收{income}萬
+    語錄："{quotes}"
+    【現有保障缺口表】(系統計算)
+    {coverage_table}
+    
+    {proposal_context}
+    【指定及白名單商品】: {product_context}
+    【商品給付表 (依缺口、年齡、幣別篩選)】
+    {benefit_table or "(無符合商品)"}
+    【知識庫】: {kb_context}
+
+    【輸出架構】
+    1. **[💖 暖心開場]** (NLP)
+    2. **[❓ SPIN 情境探索]**
+    3. **[📊 保單健診與缺口分析]** (請畫出上述定義的直球對決表格)
+    4. **[🛡️ 專屬規劃建議]** (針對缺口提出 Excel/手冊中的商品建議)
+    5. **[💡 補充建議]** (其他提醒)
+    """
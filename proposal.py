@@ -0,0 +1,160 @@
+# --- 建議書 PDF 擷取 ---
+# 1. 以檔案內容雜湊快取結果，同一份建議書重複送出不再重新解析。
+# 2. 先用 pypdfium2 快速掃過每頁文字，找出「彙整表」頁，用 pdfplumber 的表格擷取整理成表格文字。
+# 3. 其餘頁面分批交給 process pool，依頁序累積，字數預算滿了就停止並取消還沒開始的批次。
+#    PDF 先寫成暫存檔，各批次只傳路徑，不必把整份檔案複製給每個批次。
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import timed
+
+try:
+    import pdfplumber
+except ImportError:
+    pdfplumber = None
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+PROPOSAL_BUDGET = 40000   # 解析時的字數上限 (提早停止用)；放進提示詞時再依模型的 token 額度裁切
+SUMMARY_KEYWORDS = ("彙整", "彙總", "保障內容總覽", "保障明細表")
+PAGES_PER_TASK = 4
+INLINE_MAX_PAGES = 8      # 頁數不多時直接在本執行緒處理，省下開 process 的成本
+MAX_WORKERS = max(1, min(4, os.cpu_count() or 1))
+CACHE_SIZE = 64
+
+_cache = OrderedDict()    # 內容雜湊 -> 擷取結果
+_cache_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    # 由背景工作執行緒在多執行緒的 Streamlit 行程中建立，不能用 fork (子行程可能繼承被鎖住的鎖)
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _pool
+
+
+def _open(source):
+    # source 為 bytes 或暫存檔路徑
+    return pdfplumber.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+
+
+def _quick_page_texts(data):
+    # 只用來判斷哪幾頁是彙整表；pypdfium2 比 pdfplumber 快很多
+    if pdfium is None: return None
+    try:
+        pdf = pdfium.PdfDocument(data)
+        try:
+            texts = []
+            for i in range(len(pdf)):
+                page = pdf[i]
+                tp = page.get_textpage()
+                texts.append(tp.get_text_range())
+                tp.close()
+                page.close()
+            return texts
+        finally:
+            pdf.close()
+    except Exception:
+        return None
+
+
+def _table_text(page):
+    rows = []
+    for table in page.extract_tables():
+        for row in table:
+            cells = [str(c).replace("\n", " ").strip() for c in row if c not in (None, "")]
+            if cells: rows.append(" | ".join(cells))
+    return "\n".join(rows)
+
+
+def _extract_pages(source, indices):
+    # process pool 的工作：開啟 PDF 並擷取指定頁面的文字 (子行程中執行)
+    with _open(source) as pdf:
+        return [(i, pdf.pages[i].extract_text() or "") for i in indices]
+
+
+def _extract_summary_pages(data, indices):
+    out = []
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        for i in indices:
+            page = pdf.pages[i]
+            table = _table_text(page)
+            out.append(table or page.extract_text() or "")
+    return out
+
+
+@timed("proposal.extract")
+def extract_proposal_text(data, budget=PROPOSAL_BUDGET):
+    # data 為上傳檔案的 bytes；回傳 (文字, 彙整表頁碼清單)，頁碼從 1 起算
+    key = hashlib.sha256(data).hexdigest()
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    quick = _quick_page_texts(data)
+    if quick is None:
+        with pdfplumber.open(io.BytesIO(data)) as pdf:
+            quick = [p.extract_text() or "" for p in pdf.pages]
+    summary_pages = [i for i, t in enumerate(quick) if any(k in t for k in SUMMARY_KEYWORDS)]
+
+    parts, used = [], 0
+    if summary_pages:
+        for i, text in zip(summary_pages, _extract_summary_pages(data, summary_pages)):
+            parts.append(f"【彙整表 第{i + 1}頁】\n{text}")
+            used += len(text)
+
+    skip = set(summary_pages)
+    rest = [i for i in range(len(quick)) if i not in skip]
+    if used < budget and rest:
+        chunks = [rest[i:i + PAGES_PER_TASK] for i in range(0, len(rest), PAGES_PER_TASK)]
+        # 頁數不多或只有一顆 CPU 時在本執行緒依序處理，開 process 只是多出成本
+        inline = len(rest) <= INLINE_MAX_PAGES or MAX_WORKERS == 1
+        futures, tmp_path = [], None
+        try:
+            if inline:
+                results = (_extract_pages(data, chunk) for chunk in chunks)
+            else:
+                # 暫存檔建立後的每一步 (含開 process pool) 失敗都要由下面的 finally 刪檔
+                with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+                    tmp_path = tmp.name
+                    tmp.write(data)
+                pool = _get_pool()
+                for chunk in chunks: futures.append(pool.submit(_extract_pages, tmp_path, chunk))
+                results = (f.result() for f in futures)
+            for pages in results:
+                for _, text in pages:
+                    if not text: continue
+                    parts.append(text)
+                    used += len(text)
+                if used >= budget: break
+        finally:
+            for f in futures: f.cancel()
+            if tmp_path:
+                # 已開始的批次要等它們讀完檔案才能刪除
+                for f in futures:
+                    if not f.cancelled(): f.exception()
+                os.remove(tmp_path)
+
+    text = "\n".join(parts)
+    if len(text) > budget:
+        cut = text.rfind("\n", 0, budget)
+        text = text[:cut if cut > 0 else budget]
+    result = (text, [i + 1 for i in summary_pages])
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > CACHE_SIZE: _cache.popitem(last=False)
+    return result
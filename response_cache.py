@@ -0,0 +1,53 @@
+# --- AI 回應快取 ---
+# 同一個模型、同一份提示詞 (忽略縮排與空白差異)、同一版知識庫，直接回傳上次的結果，
+# 不再呼叫 Gemini，也不佔用 429 額度。存在 insurance_crm.db 的 llm_cache 資料表，
+# 超過 TTL 失效，筆數超過上限時淘汰最久沒用到的。
+import hashlib
+import re
+import time
+
+from db import get_conn
+
+CACHE_TTL = 7 * 24 * 3600
+CACHE_MAX_ENTRIES = 2000
+
+
+def normalize_prompt(prompt):
+    lines = (re.sub(r'\s+', ' ', line).strip() for line in str(prompt).splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def cache_key(model_name, prompt, kb_version=""):
+    raw = f"{model_name}\x00{kb_version}\x00{normalize_prompt(prompt)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def get_cached(key, ttl=CACHE_TTL):
+    conn = get_conn()
+    row = conn.execute("SELECT response, created_at FROM llm_cache WHERE key=?", (key,)).fetchone()
+    if not row: return None
+    now = time.time()
+    with conn:
+        if now - row[1] > ttl:
+            conn.execute("DELETE FROM llm_cache WHERE key=?", (key,))
+            return None
+        conn.execute("UPDATE llm_cache SET last_used=? WHERE key=?", (now, key))
+    return row[0]
+
+
+def put_cached(key, model_name, response, max_entries=CACHE_MAX_ENTRIES):
+    conn = get_conn()
+    now = time.time()
+    with conn:
+        conn.execute('''INSERT INTO llm_cache (key, model, response, created_at, last_used) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(key) DO UPDATE SET response=excluded.response,
+                        created_at=excluded.created_at, last_used=excluded.last_used''',
+                     (key, model_name, response, now, now))
+        conn.execute('''DELETE FROM llm_cache WHERE key IN
+                        (SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)''', (max_entries,))
+
+
+def clear_cache():
+    conn = get_conn()
+    with conn:
+        conn.execute("DELETE FROM llm_cache")
@@ -0,0 +1,195 @@
+# --- Gemini 呼叫排程 ---
+# 整個行程共用一個排程器：每個模型各有「每分鐘請求數」與「每分鐘 token 數」兩個 token bucket，
+# 再加上同時呼叫數上限。同一額度類別的呼叫依先來後到排隊 (FIFO)，輪到且額度足夠才放行；
+# 遇到 429 時該類模型暫停 (依伺服器建議的等待秒數)，同類的 session 一起等，不會同時重撞，
+# 其他類別的模型照常放行。
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# 依模型名稱關鍵字對應額度 (先符合者優先)；可用環境變數 GEMINI_RATE_LIMITS 覆寫，
+# 例如 {"flash": {"rpm": 1000, "tpm": 4000000}}
+DEFAULT_LIMITS = {
+    "flash": {"rpm": 60, "tpm": 1_000_000},
+    "pro": {"rpm": 10, "tpm": 250_000},
+    "default": {"rpm": 30, "tpm": 500_000},
+}
+MAX_CONCURRENCY = 4
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 60.0
+
+RETRY_HINTS = [
+    re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)'),
+    re.compile(r'retry[- ]after[:\s]+(\d+(?:\.\d+)?)', re.I),
+    re.compile(r'retry in (\d+(?:\.\d+)?)\s*s', re.I),
+]
+
+
+def model_name(model):
+    # 模型物件或名稱字串 -> 模型名稱
+    return getattr(model, "model_name", str(model))
+
+
+def model_kind(model, table):
+    # 依模型名稱關鍵字對應的設定表 (額度、預算等) 中，第一個出現在名稱裡的關鍵字；都沒有時為 "default"
+    name = model_name(model).lower()
+    return next((k for k in table if k != "default" and k in name), "default")
+
+
+def pick_by_model(table, model):
+    return table[model_kind(model, table)]
+
+
+def estimate_tokens(text):
+    # 粗估：中日韓文字約一字一 token，其餘約四個字元一 token
+    text = str(text)
+    cjk = sum(1 for ch in text if '㐀' <= ch <= '鿿')
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+def is_rate_limited(exc):
+    return "429" in str(exc) or "ResourceExhausted" in type(exc).__name__
+
+
+def retry_after(exc):
+    # 從錯誤訊息找伺服器建議的等待秒數，找不到回傳 None
+    msg = str(exc)
+    for pattern in RETRY_HINTS:
+        m = pattern.search(msg)
+        if m: return float(m.group(1))
+    return None
+
+
+def backoff_delay(attempt, hint=None):
+    # 指數退避 + 隨機抖動，避免多個 session 同一秒重試；有伺服器建議時至少等那麼久
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    return max(delay, hint or 0)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+
+class Scheduler:
+    def __init__(self, limits=None, max_concurrency=MAX_CONCURRENCY):
+        self.limits = dict(limits or DEFAULT_LIMITS)
+        self.max_concurrency = max_concurrency
+        self._cond = threading.Condition()
+        self._queues = {}     # 額度類別 -> 排隊中的 ticket
+        self._running = 0
+        self._buckets = {}
+        self._paused_until = {}
+        self.stats = {"calls": 0, "rate_limited": 0, "failed": 0}
+
+    def configure(self, key, rpm, tpm):
+        with self._cond:
+            self.limits[key] = {"rpm": rpm, "tpm": tpm}
+            self._buckets.clear()
+
+    def _limit_key(self, model_name):
+        return model_kind(model_name, self.limits)
+
+    def _bucket(self, model_name):
+        key = self._limit_key(model_name)
+        if key not in self._buckets:
+            lim = self.limits[key]
+            self._buckets[key] = (TokenBucket(lim["rpm"]), TokenBucket(lim["tpm"]))
+        return key, self._buckets[key]
+
+    def _wait_time(self, model_name, tokens, now):
+        key, (req, tok) = self._bucket(model_name)
+        paused = max(0.0, self._paused_until.get(key, 0) - now)
+        return max(paused, req.wait_time(1, now), tok.wait_time(tokens, now))
+
+    def queue_length(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    @contextmanager
+    def slot(self, model_name, tokens=0, on_wait=None):
+        # on_wait(排隊位置)：需要等待時呼叫 (第 1 位表示同類模型下一個就輪到)，用來在畫面顯示；
+        # 在鎖外呼叫，callback 慢 (寫資料庫、更新畫面) 也不會卡住其他 session 排隊
+        ticket = object()
+        with self._cond:
+            queue = self._queues.setdefault(self._limit_key(model_name), deque())
+            queue.append(ticket)
+        last_pos = None
+        try:
+            while True:
+                with self._cond:
+                    pos = queue.index(ticket)
+                    wait = 1.0
+                    if pos == 0 and self._running < self.max_concurrency:
+                        now = time.monotonic()
+                        wait = self._wait_time(model_name, tokens, now)
+                        if wait <= 0:
+                            queue.popleft()
+                            self._running += 1
+                            _, (req, tok) = self._bucket(model_name)
+                            req.take(1, now)
+                            tok.take(tokens, now)
+                            self.stats["calls"] += 1
+                            self._cond.notify_all()
+                            break
+                    if not on_wait or pos == last_pos:
+                        self._cond.wait(timeout=min(max(wait, 0.05), 1.0))
+                        continue
+                on_wait(pos + 1)
+                last_pos = pos
+        except BaseException:
+            with self._cond:
+                if ticket in queue: queue.remove(ticket)
+                self._cond.notify_all()
+            raise
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    def throttled(self, model_name, delay):
+        # 收到 429：同類模型暫停 delay 秒，排在這一類的 session 一起等
+        with self._cond:
+            key = self._limit_key(model_name)
+            self._paused_until[key] = max(self._paused_until.get(key, 0), time.monotonic() + delay)
+            self.stats["rate_limited"] += 1
+            self._cond.notify_all()
+
+    def failed(self):
+        with self._cond:
+            self.stats["failed"] += 1
+
+
+def _load_limits():
+    limits = dict(DEFAULT_LIMITS)
+    try: limits.update(json.loads(os.environ.get("GEMINI_RATE_LIMITS", "{}")))
+    except ValueError: pass
+    return limits
+
+
+scheduler = Scheduler(_load_limits())
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from coverage import coverage_gaps, gap_table, parse_amount  # noqa: E402
+
+
+def test_parse_amount_units():
+    assert parse_amount("4000元/日") == (4000.0, 0.0)
+    assert parse_amount("1.5萬") == (15000.0, 0.0)
+    assert parse_amount("2000+2000") == (4000.0, 0.0)
+    assert parse_amount("5倍") == (0.0, 5.0)
+
+
+def test_parse_amount_bare_numbers_follow_item_threshold():
+    # 月給付：3 是 3 萬，5000 是 5000 元
+    assert parse_amount("3", 100) == (30000.0, 0.0)
+    assert parse_amount("5000", 100) == (5000.0, 0.0)
+    # 一筆金：50 是 50 萬，300000 是元
+    assert parse_amount("50", 1000) == (500000.0, 0.0)
+    assert parse_amount("300000", 1000) == (300000.0, 0.0)
+
+
+def test_small_monthly_benefits_are_short():
+    _, _, gap = coverage_gaps(pd.DataFrame([{"cov_ltc": "5000", "cov_dis": "8000"}]))
+    assert gap.at[0, "長照月給付"] == 25000
+    assert gap.at[0, "失能月給付"] == 22000
+
+
+def test_gap_table_status():
+    table = gap_table({"income": "80", "cov_ltc": "5000", "cov_dis": "3", "cov_cancer": "50", "cov_life": "5倍"})
+    rows = {line.split("|")[1].strip(): line for line in table.splitlines()[2:]}
+    assert "未達標" in rows["長照月給付"]
+    assert "達標" in rows["失能月給付"] and "未達標" not in rows["失能月給付"]
+    assert "未達標" not in rows["癌症一筆金"]
+    assert "未達標" not in rows["壽險"]